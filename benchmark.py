@@ -0,0 +1,309 @@
+# encoding:utf-8
+"""
+离线压测：用合成的群聊消息和替身bot测量入库、查询、切分和合并各环节的耗时，不需要网络
+
+在chatgpt-on-wechat根目录下执行：
+    python -m plugins.plugin_summary.benchmark --output bench.json
+    python -m plugins.plugin_summary.benchmark --baseline bench.json
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+from bridge.context import Context, ContextType
+from plugins import Event, EventContext
+from plugins.plugin_summary.db import Db
+from plugins.plugin_summary.main import Summary
+
+WORDS = ["今天", "发布", "版本", "测试", "哈哈", "明天", "开会", "需求", "上线", "问题", "好的", "收到", "周末", "吃饭",
+         "代码", "接口", "文档", "部署", "回滚", "性能", "数据库", "群聊", "机器人", "总结", "+1", "[捂脸]", "[强]"]
+
+
+class FakeSession:
+    def __init__(self, session_id, system_prompt):
+        self.session_id = session_id
+        self.messages = [{"role": "system", "content": system_prompt}]
+
+    def set_system_prompt(self, system_prompt):
+        self.messages = [{"role": "system", "content": system_prompt}]
+
+    def add_query(self, query):
+        self.messages.append({"role": "user", "content": query})
+
+    # 按字符数计数，保证不同环境下结果一致
+    def calc_tokens(self):
+        return sum(len(message["content"]) + 4 for message in self.messages)
+
+
+class FakeSessionManager:
+    def __init__(self):
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def build_session(self, session_id, system_prompt=None):
+        with self.lock:
+            if session_id is None:
+                return FakeSession(session_id, system_prompt)
+            if session_id not in self.sessions:
+                self.sessions[session_id] = FakeSession(session_id, system_prompt)
+            elif system_prompt is not None:
+                self.sessions[session_id].set_system_prompt(system_prompt)
+            return self.sessions[session_id]
+
+
+class FakeBot:
+    """替身bot，按固定延迟返回固定长度的摘要，并统计调用次数和token数"""
+
+    def __init__(self, latency=0.0, completion_tokens=200):
+        self.sessions = FakeSessionManager()
+        self.args = {}
+        self.latency = latency
+        self.completion_tokens = completion_tokens
+        # 复制出来的bot共享同一份统计
+        self.stats = {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0}
+        self.lock = threading.Lock()
+
+    def reply_text(self, session, *args, **kwargs):
+        prompt_tokens = session.calc_tokens()
+        max_tokens = self.args.get("max_tokens") or self.completion_tokens
+        completion_tokens = min(self.completion_tokens, max_tokens)
+        if self.latency > 0:
+            time.sleep(self.latency)
+        with self.lock:
+            self.stats["calls"] += 1
+            self.stats["prompt_tokens"] += prompt_tokens
+            self.stats["completion_tokens"] += completion_tokens
+        return {"total_tokens": prompt_tokens + completion_tokens, "completion_tokens": completion_tokens,
+                "content": "要" * completion_tokens}
+
+
+class TrafficGenerator:
+    """生成多个群的合成聊天消息"""
+
+    def __init__(self, groups=20, users_per_group=50, min_length=4, max_length=80, seed=1):
+        self.random = random.Random(seed)
+        self.groups = ["群聊%d" % i for i in range(groups)]
+        self.users = ["用户%d" % i for i in range(users_per_group)]
+        self.min_length = min_length
+        self.max_length = max_length
+        self.msg_id = 0
+
+    def content(self):
+        length = self.random.randint(self.min_length, self.max_length)
+        words = []
+        while sum(len(word) for word in words) < length:
+            words.append(self.random.choice(WORDS))
+        return "".join(words)
+
+    # 返回 (session_id, msg_id, user, content, type, timestamp)
+    def message(self, timestamp, group=None):
+        self.msg_id += 1
+        group = group or self.random.choice(self.groups)
+        msg_type = ContextType.IMAGE if self.random.random() < 0.05 else ContextType.TEXT
+        return group, self.msg_id, self.random.choice(self.users), self.content(), msg_type, timestamp
+
+
+def _percentiles(samples):
+    if not samples:
+        return {}
+    samples = sorted(samples)
+    return {
+        "mean_ms": statistics.mean(samples) * 1000,
+        "p50_ms": samples[len(samples) // 2] * 1000,
+        "p99_ms": samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1000,
+        "max_ms": samples[-1] * 1000,
+    }
+
+
+def _receive_context(message):
+    session_id, msg_id, user, content, msg_type, timestamp = message
+    cmsg = SimpleNamespace(from_user_id=session_id, from_user_nickname=session_id, actual_user_id=user,
+                           actual_user_nickname=user, msg_id=msg_id, create_time=timestamp, is_at=False)
+    context = Context(msg_type, content, {"msg": cmsg, "isgroup": True})
+    return EventContext(Event.ON_RECEIVE_MESSAGE, {"context": context})
+
+
+def bench_ingest(plugin, generator, count, rate):
+    """通过on_receive_message入库，rate为每秒消息数，0表示不限速"""
+    now = int(time.time())
+    messages = [generator.message(now - count + i) for i in range(count)]
+    latencies = []
+    start = time.perf_counter()
+    for i, message in enumerate(messages):
+        if rate > 0:
+            delay = start + i / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        begin = time.perf_counter()
+        plugin.on_receive_message(_receive_context(message))
+        latencies.append(time.perf_counter() - begin)
+    plugin.db.flush()
+    elapsed = time.perf_counter() - start
+    return dict(messages=count, seconds=elapsed, messages_per_second=count / elapsed, **_percentiles(latencies))
+
+
+def bench_insert(db, generator, count):
+    """直接调用Db.insert_record入库"""
+    now = int(time.time())
+    messages = [generator.message(now - count + i) for i in range(count)]
+    start = time.perf_counter()
+    for session_id, msg_id, user, content, msg_type, timestamp in messages:
+        db.insert_record(session_id, msg_id, user, content, str(msg_type), timestamp, 0)
+    db.flush()
+    elapsed = time.perf_counter() - start
+    return {"messages": count, "seconds": elapsed, "messages_per_second": count / elapsed}
+
+
+def bench_get_records(db, generator, sizes, limit, repeat):
+    """在不同的表大小下测量get_records耗时"""
+    results = []
+    total = 0
+    now = int(time.time())
+    for size in sizes:
+        while total < size:
+            batch = min(10000, size - total)
+            for session_id, msg_id, user, content, msg_type, timestamp in \
+                    (generator.message(now - size + total + i) for i in range(batch)):
+                db.insert_record(session_id, msg_id, user, content, str(msg_type), timestamp, 0)
+            db.flush()
+            total += batch
+        samples = []
+        for i in range(repeat):
+            group = generator.groups[i % len(generator.groups)]
+            begin = time.perf_counter()
+            rows = db.get_records(group, 0, limit)
+            samples.append(time.perf_counter() - begin)
+        results.append(dict(table_rows=total, limit=limit, rows=len(rows), **_percentiles(samples)))
+    return results
+
+
+def bench_summary(plugin, generator, messages, runs):
+    """切分、分段摘要和合并的完整流程，首次为冷启动，之后可命中分段摘要缓存"""
+    group = "压测群"
+    now = int(time.time())
+    for i in range(messages):
+        session_id, msg_id, user, content, msg_type, timestamp = generator.message(now - messages + i, group)
+        plugin.db.insert_record(session_id, msg_id, user, content, str(msg_type), timestamp, 0)
+    plugin.db.flush()
+    results = []
+    for run in range(runs):
+        stats = plugin.bot.stats
+        before = dict(stats)
+        begin = time.perf_counter()
+        reply = plugin._summarize(group, 0, messages)
+        elapsed = time.perf_counter() - begin
+        results.append({
+            "run": run,
+            "seconds": elapsed,
+            "reply_type": str(reply.type),
+            "llm_calls": stats["calls"] - before["calls"],
+            "prompt_tokens": stats["prompt_tokens"] - before["prompt_tokens"],
+            "completion_tokens": stats["completion_tokens"] - before["completion_tokens"],
+        })
+    return results
+
+
+def compare(result, baseline, threshold):
+    """与基线结果比较，耗时增长超过threshold的指标视为退化"""
+    regressions = []
+
+    def walk(path, current, base):
+        if isinstance(current, dict) and isinstance(base, dict):
+            for key in current:
+                if key in base:
+                    walk(path + [key], current[key], base[key])
+        elif isinstance(current, list) and isinstance(base, list):
+            for i, (c, b) in enumerate(zip(current, base)):
+                walk(path + [str(i)], c, b)
+        elif isinstance(current, (int, float)) and isinstance(base, (int, float)) and base > 0:
+            name = path[-1]
+            if name.endswith("_ms") or name == "seconds":
+                ratio = current / base
+            elif name == "messages_per_second":
+                ratio = base / current if current > 0 else float("inf")
+            else:
+                return
+            if ratio > 1 + threshold:
+                regressions.append({"metric": ".".join(path), "baseline": base, "current": current})
+
+    walk([], result, baseline)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="summary plugin offline benchmark")
+    parser.add_argument("--groups", type=int, default=20)
+    parser.add_argument("--min-length", type=int, default=4)
+    parser.add_argument("--max-length", type=int, default=80)
+    parser.add_argument("--ingest", type=int, default=5000, help="number of messages for ingest benchmarks")
+    parser.add_argument("--rate", type=float, default=0, help="messages per second, 0 means unlimited")
+    parser.add_argument("--sizes", default="1000,10000,100000", help="table sizes for get_records")
+    parser.add_argument("--limit", type=int, default=999)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--summary-messages", type=int, default=3000)
+    parser.add_argument("--summary-runs", type=int, default=2)
+    parser.add_argument("--latency", type=float, default=0.5, help="stand-in bot latency in seconds")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--storage", default="single", choices=["single", "sharded", "memory"])
+    parser.add_argument("--shards", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--label", default="")
+    parser.add_argument("--output", help="write results to this json file")
+    parser.add_argument("--baseline", help="compare with a previous json result")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed slowdown ratio when comparing")
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix="summary-bench-")
+    config = {"save_time": -1, "summary_concurrency": args.concurrency, "summary_cache": True}
+    try:
+        generator = TrafficGenerator(args.groups, min_length=args.min_length, max_length=args.max_length,
+                                     seed=args.seed)
+        result = {
+            "label": args.label,
+            "time": int(time.time()),
+            "python": sys.version.split()[0],
+            "sqlite": sqlite3.sqlite_version,
+            "args": vars(args),
+        }
+
+        db = Db(db_path=os.path.join(workdir, "ingest.db"), storage=args.storage, shards=args.shards)
+        plugin = Summary(config=config, db=db, bot=FakeBot(args.latency))
+        result["ingest"] = bench_ingest(plugin, generator, args.ingest, args.rate)
+        result["insert_record"] = bench_insert(db, generator, args.ingest)
+        db.close()
+
+        db = Db(db_path=os.path.join(workdir, "query.db"), storage=args.storage, shards=args.shards)
+        sizes = [int(size) for size in args.sizes.split(",") if size]
+        result["get_records"] = bench_get_records(db, generator, sizes, args.limit, args.repeat)
+        db.close()
+
+        db = Db(db_path=os.path.join(workdir, "summary.db"), storage=args.storage, shards=args.shards)
+        plugin = Summary(config=config, db=db, bot=FakeBot(args.latency))
+        result["summary"] = bench_summary(plugin, generator, args.summary_messages, args.summary_runs)
+        db.close()
+
+        if args.baseline:
+            with open(args.baseline, "r", encoding="utf-8") as f:
+                result["regressions"] = compare(result, json.load(f), args.threshold)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+    print(output)
+    return 1 if result.get("regressions") else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,97 @@
+# encoding:utf-8
+"""
+本地解析常见的中文总结指令，如"3小时内"、"前99条"、"今天"、"最近半天"、"关于发布"，解析不了的再交给模型翻译
+"""
+import re
+import time
+
+CN_DIGITS = {"零": 0, "〇": 0, "一": 1, "二": 2, "两": 2, "三": 3, "四": 4, "五": 5, "六": 6, "七": 7, "八": 8, "九": 9}
+CN_UNITS = {"十": 10, "百": 100, "千": 1000, "万": 10000}
+
+NUMBER = r"[0-9]+|[零〇一二两三四五六七八九十百千万]+"
+
+DURATION_UNITS = {
+    "秒": 1,
+    "分钟": 60,
+    "分": 60,
+    "小时": 3600,
+    "钟头": 3600,
+    "天": 86400,
+    "日": 86400,
+    "周": 7 * 86400,
+    "星期": 7 * 86400,
+}
+
+COUNT_PATTERN = re.compile(r"(?:前|最近|最新|近)?\s*(%s)\s*条" % NUMBER)
+DURATION_PATTERN = re.compile(r"(%s)?\s*(个)?\s*(半)?\s*(个)?\s*(分钟|小时|钟头|星期|秒|分|天|日|周)\s*(?:以内|之内|内)?" % NUMBER)
+# 只支持到当前时间为止的范围，"昨天"、"前天"需要结束时间，交给模型翻译
+DAY_PATTERN = re.compile(r"今天|今日")
+# "关于发布和上线"、"话题：版本"，多个关键字用和、或、顿号分隔，遇到"的"结束
+TOPIC_PATTERN = re.compile(r"(?:关于|有关|话题|主题)\s*[:：]?\s*([^\s,.，。!！?？~的]+)")
+TOPIC_SEPARATOR = re.compile(r"[和或、/|]")
+# 去掉这些词后若没有剩余内容，则按默认参数总结
+FILLER_PATTERN = re.compile(r"总结|一下|下|吧|呢|哦|帮我|帮忙|请|给我|最近|最新|群|里|的|聊天|记录|消息|信息|内容|相关|讨论|方面|话题|主题|"
+                            r"[\s,.，。!！?？~]")
+
+
+def cn_to_int(text):
+    if text.isdigit():
+        return int(text)
+    total, section, number = 0, 0, 0
+    for char in text:
+        if char in CN_DIGITS:
+            number = CN_DIGITS[char]
+        elif char == "万":
+            total += (section + number) * 10000
+            section, number = 0, 0
+        else:
+            # "十"前面没有数字时表示"一十"
+            section += (number or 1) * CN_UNITS[char]
+            number = 0
+    # "两万五"、"三百五"末尾紧跟在单位后的数字表示下一级单位
+    if number and len(text) > 1 and CN_UNITS.get(text[-2], 0) >= 100:
+        number *= CN_UNITS[text[-2]] // 10
+    return total + section + number
+
+
+def _day_start(now):
+    local = time.localtime(now)
+    return time.mktime((local.tm_year, local.tm_mon, local.tm_mday, 0, 0, 0, 0, 0, -1))
+
+
+def parse_summary_command(text, now=None):
+    """
+    解析总结指令，返回{"count": 条数, "duration_in_seconds": 秒数, "keywords": [关键字]}，缺省的参数不返回；无法解析时返回None
+    """
+    now = time.time() if now is None else now
+    args = {}
+    rest = text
+
+    match = COUNT_PATTERN.search(rest)
+    if match:
+        args["count"] = cn_to_int(match.group(1))
+        rest = rest[:match.start()] + rest[match.end():]
+
+    match = DAY_PATTERN.search(rest)
+    if match:
+        args["duration_in_seconds"] = int(now - _day_start(now))
+        rest = rest[:match.start()] + rest[match.end():]
+    else:
+        match = DURATION_PATTERN.search(rest)
+        if match and (match.group(1) or match.group(3)):
+            amount = cn_to_int(match.group(1)) if match.group(1) else 0
+            if match.group(3):
+                amount += 0.5
+            args["duration_in_seconds"] = int(amount * DURATION_UNITS[match.group(5)])
+            rest = rest[:match.start()] + rest[match.end():]
+
+    match = TOPIC_PATTERN.search(rest)
+    if match:
+        keywords = [keyword for keyword in TOPIC_SEPARATOR.split(match.group(1)) if keyword]
+        if keywords:
+            args["keywords"] = keywords
+        rest = rest[:match.start()] + rest[match.end():]
+
+    if FILLER_PATTERN.sub("", rest):
+        return None
+    return args
@@ -7,129 +7,142 @@
 @description  sqlite操作
 @Copyright (c) 2022 by sineom, All Rights Reserved.
 """
-import os
-import sqlite3
+import atexit
+import threading
 
 from common.log import logger
+from plugins.plugin_summary.storage import COMPRESS_THRESHOLD, create_storage
+from plugins.plugin_summary.tokenizer import normalize_content, record_tokens
 
 
 class Db:
-    def __init__(self):
-        curdir = os.path.dirname(__file__)
-        db_path = os.path.join(curdir, "chat.db")
-        self.conn = sqlite3.connect(db_path, check_same_thread=False)
-        c = self.conn.cursor()
-        c.execute('''CREATE TABLE IF NOT EXISTS chat_records
-                            (sessionid TEXT, msgid INTEGER, user TEXT, content TEXT, type TEXT, timestamp INTEGER, is_triggered INTEGER,
-                            PRIMARY KEY (sessionid, msgid))''')
-
-        # 创建一个总结时间表，记录合适开始了总结的时间
-        c.execute('''CREATE TABLE IF NOT EXISTS summary_time
-                            (sessionid TEXT, summary_time INTEGER, PRIMARY KEY (sessionid))''')
-
-        # 创建一个关闭保存聊天记录的表
-        c.execute('''CREATE TABLE IF NOT EXISTS summary_stop
-                            (sessionid TEXT, PRIMARY KEY (sessionid))''')
-
-        # 后期增加了is_triggered字段，这里做个过渡，这段代码某天会删除
-        c = c.execute("PRAGMA table_info(chat_records);")
-        column_exists = False
-        for column in c.fetchall():
-            logger.debug("[Summary] column: {}".format(column))
-            if column[1] == 'is_triggered':
-                column_exists = True
-                break
-        if not column_exists:
-            self.conn.execute("ALTER TABLE chat_records ADD COLUMN is_triggered INTEGER DEFAULT 0;")
-            self.conn.execute("UPDATE chat_records SET is_triggered = 0;")
-
-        self.conn.commit()
-        # 禁用的群聊
-        self.disable_group = self._get_summary_stop()
+    """
+    写缓冲和会话状态等便捷方法，实际的读写交给storage中的存储后端
+    """
+
+    def __init__(self, flush_batch_size=100, flush_interval=2, db_path=None, compress_threshold=COMPRESS_THRESHOLD,
+                 busy_timeout=5000, storage="single", shards=8):
+        self.storage = create_storage(storage, db_path, shards, compress_threshold, busy_timeout)
+
+        # 写缓冲：消息先进入内存队列，按数量或时间阈值批量落盘，一个事务只提交一次
+        self.flush_batch_size = max(1, flush_batch_size)
+        self.flush_interval = flush_interval
+        self._pending = []
+        self._pending_lock = threading.Lock()
+        # 保证flush返回时此前缓冲的记录都已写入，而不是正在被其他线程写入
+        self._flush_lock = threading.Lock()
+        self._closed = threading.Event()
+        self._flusher = None
+        if self.flush_interval > 0:
+            self._flusher = threading.Thread(target=self._flush_loop, name="summary-db-flush", daemon=True)
+            self._flusher.start()
+        atexit.register(self.close)
 
     def insert_record(self, session_id, msg_id, user, content, msg_type, timestamp, is_triggered=0):
-        c = self.conn.cursor()
         logger.debug("[Summary] insert record: {} {} {} {} {} {} {}".format(session_id, msg_id, user, content, msg_type,
                                                                             timestamp, is_triggered))
-        c.execute("INSERT OR REPLACE INTO chat_records VALUES (?,?,?,?,?,?,?)",
-                  (session_id, msg_id, user, content, msg_type, timestamp, is_triggered))
-        self.conn.commit()
-
-    # 根据时间删除记录
-    def delete_records(self, start_timestamp):
-        try:
-            c = self.conn.cursor()
-            c.execute('''
-                        DELETE FROM chat_records
-                        WHERE timestamp < ?
-                    ''', start_timestamp,)
-            self.conn.commit()
-            logger.info("Records older have been cleaned.")
-        except Exception as e:
-            logger.error(e)
-
-    # 保存总结时间，如果表中不存在则插入，如果存在则更新
+        # 总结时使用的内容和token数在入库时计算一次
+        summary_text = normalize_content(content, msg_type)
+        tokens = record_tokens(user, summary_text, is_triggered)
+        with self._pending_lock:
+            self._pending.append((session_id, msg_id, user, content, msg_type, timestamp, is_triggered, tokens,
+                                  summary_text))
+            full = len(self._pending) >= self.flush_batch_size
+        if full or self._closed.is_set():
+            self.flush()
+
+    # 将缓冲区中的记录一次性写入数据库
+    def flush(self):
+        with self._flush_lock:
+            with self._pending_lock:
+                batch, self._pending = self._pending, []
+            if not batch:
+                return 0
+            failed = self.storage.insert_records(batch)
+            if failed:
+                # 写入失败时放回队列，等待下次重试
+                with self._pending_lock:
+                    self._pending[:0] = failed
+            logger.debug("[Summary] flushed {} records".format(len(batch) - len(failed)))
+            return len(batch) - len(failed)
+
+    def _flush_loop(self):
+        while not self._closed.wait(self.flush_interval):
+            self.flush()
+
+    # 关闭时把剩余的记录写入数据库
+    def close(self):
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        if self._flusher is not None:
+            self._flusher.join(timeout=self.flush_interval + 1)
+        self.flush()
+        self.storage.close()
+
+    # 根据时间删除记录，每次最多删除limit条，返回删除的条数
+    def delete_records(self, start_timestamp, session_id=None, exclude=(), limit=500):
+        return self.storage.delete_records(start_timestamp, session_id, exclude, limit)
+
+    # 删除最早的limit条记录，用于数据库超出容量上限时
+    def delete_oldest_records(self, limit=500):
+        return self.storage.delete_oldest_records(limit)
+
+    # 删除过期的分段摘要缓存，与聊天记录的保存时间保持一致
+    def delete_summary_cache(self, start_timestamp, session_id=None, exclude=()):
+        self.storage.delete_summary_cache(start_timestamp, session_id, exclude)
+
+    # 数据库中实际使用的空间(字节)，不含空闲页
+    def used_size(self):
+        return self.storage.used_size()
+
+    def incremental_vacuum(self, pages=1000):
+        self.storage.incremental_vacuum(pages)
+
+    # 旧库开启增量回收，需要整理重建整个数据库，期间阻塞写入
+    def enable_incremental_vacuum(self):
+        return self.storage.enable_incremental_vacuum()
+
+    def get_summary_cache(self, session_id, start_timestamp=0) -> list:
+        return self.storage.get_summary_cache(session_id, start_timestamp)
+
+    def save_summary_cache(self, session_id, entries, create_time):
+        self.storage.save_summary_cache(session_id, entries, create_time)
+
+    # 最新一段摘要之后有足够多新消息的会话，用于后台预先总结
+    def pending_sessions(self, start_timestamp, end_timestamp, min_messages, limit=10) -> list:
+        self.flush()
+        return self.storage.pending_sessions(start_timestamp, end_timestamp, min_messages, limit)
+
+    # 获取会话状态，不存在时返回默认值
+    def get_session_state(self, session_id) -> dict:
+        return self.storage.get_session_state(session_id)
+
+    def set_session_state(self, session_id, field, value):
+        self.storage.set_session_state(session_id, field, value)
+
+    # 保存总结时间
     def save_summary_time(self, session_id, summary_time):
-        if self.get_summary_time(session_id) is None:
-            self._insert_summary_time(session_id, summary_time)
-        else:
-            self._update_summary_time(session_id, summary_time)
-
-    # 插入总结时间
-    def _insert_summary_time(self, session_id, summary_time):
-        c = self.conn.cursor()
-        logger.debug("[Summary] insert summary time: {} {}".format(session_id, summary_time))
-        c.execute("INSERT OR REPLACE INTO summary_time VALUES (?,?)",
-                  (session_id, summary_time))
-        self.conn.commit()
-
-    # 更新总结时间
-    def _update_summary_time(self, session_id, summary_time):
-        c = self.conn.cursor()
-        logger.debug("[Summary] update summary time: {} {}".format(session_id, summary_time))
-        c.execute("UPDATE summary_time SET summary_time = ? WHERE sessionid = ?",
-                  (summary_time, session_id))
-        self.conn.commit()
+        self.set_session_state(session_id, "summary_time", summary_time)
 
     # 获取总结时间，如果不存在返回None
     def get_summary_time(self, session_id):
-        c = self.conn.cursor()
-        c.execute("SELECT summary_time FROM summary_time WHERE sessionid=?", (session_id,))
-        row = c.fetchone()
-        if row is None:
-            return None
-        return row[0]
+        return self.get_session_state(session_id)["summary_time"]
 
+    # 禁用或启用会话的总结
+    def set_disabled(self, session_id, disabled):
+        self.set_session_state(session_id, "disabled", int(disabled))
+
+    def is_disabled(self, session_id):
+        return bool(self.get_session_state(session_id)["disabled"])
+
+    # 返回(sessionid, msgid, user, content, type, timestamp, is_triggered, tokens)，content为归一化后的内容
     def get_records(self, session_id, start_timestamp=0, limit=9999) -> list:
-        c = self.conn.cursor()
-        c.execute("SELECT * FROM chat_records WHERE sessionid=? and timestamp>? ORDER BY timestamp DESC LIMIT ?",
-                  (session_id, start_timestamp, limit))
-        return c.fetchall()
-
-    # 删除禁用的群聊
-    def delete_summary_stop(self, session_id):
-        try:
-            c = self.conn.cursor()
-            c.execute("DELETE FROM summary_stop WHERE sessionid=?", (session_id,))
-            self.conn.commit()
-            if session_id in self.disable_group:
-                self.disable_group.remove(session_id)
-        except Exception as e:
-            logger.error(e)
-
-    # 保存禁用的群聊
-    def save_summary_stop(self, session_id):
-        try:
-            c = self.conn.cursor()
-            c.execute("INSERT OR REPLACE INTO summary_stop VALUES (?)",
-                      (session_id,))
-            self.conn.commit()
-            self.disable_group.add(session_id)
-        except Exception as e:
-            logger.error(e)
-
-    # 获取所有禁用的群聊
-    def _get_summary_stop(self):
-        c = self.conn.cursor()
-        c.execute("SELECT sessionid FROM summary_stop")
-        return set(c.fetchall())
+        # 保证总结能看到此前收到的所有消息
+        self.flush()
+        return self.storage.get_records(session_id, start_timestamp, limit)
+
+    # 按关键字查找记录，返回命中的最近limit条消息及其前后各context条消息，格式与get_records相同
+    def search_records(self, session_id, keywords, start_timestamp=0, limit=9999, context=2) -> list:
+        self.flush()
+        return self.storage.search_records(session_id, keywords, start_timestamp, limit, context)
@@ -1,8 +1,16 @@
 # encoding:utf-8
 
+import bisect
+import copy
+import hashlib
+import itertools
 import json
 import os, re
+import threading
 import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 
 from apscheduler.schedulers.background import BackgroundScheduler
 
@@ -10,15 +18,20 @@ from bot import bot_factory
 from bridge.bridge import Bridge
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
-from channel.chat_channel import check_contain, check_prefix
 from channel.chat_message import ChatMessage
-from config import conf
+from config import conf, global_config
 import plugins
 from plugins import *
 from common.log import logger
 from common import const
 
+from plugins.plugin_summary.command_parser import parse_summary_command
 from plugins.plugin_summary.db import Db
+from plugins.plugin_summary.matcher import get_matcher
+from plugins.plugin_summary.metrics import SummaryMetrics, SummaryTrace
+from plugins.plugin_summary.reducer import TRUNCATED_MARK, MessageReducer
+from plugins.plugin_summary.retention import RetentionEngine
+from plugins.plugin_summary.tokenizer import num_tokens, record_sentence, record_tokens
 
 TRANSLATE_PROMPT = '''
 You are now the following python function: 
@@ -28,10 +41,11 @@ You are now the following python function:
 Only respond with your `return` value, Don't reply anything else.
 
 Commands:
-{{Summary chat logs}}: "summary", args: {{("duration_in_seconds"): <integer>, ("count"): <integer>}}
+{{Summary chat logs}}: "summary", args: {{("duration_in_seconds"): <integer>, ("count"): <integer>, ("keywords"): <list of strings>}}
 {{Do Nothing}}:"do_nothing",  args:  {{}}
 
 argument in brackets means optional argument.
+"keywords" are the topics to summarize, only when the text asks about specific topics, e.g. "关于发布的讨论" -> ["发布"].
 
 You should only respond in JSON format as described below.
 Response Format: 
@@ -44,6 +58,20 @@ Ensure the response can be parsed by Python json.loads.
 Input: {input}
 '''
 
+MERGE_PROMPT = "你是一位群聊机器人，聊天记录已经在你的大脑中被你总结成多段摘要总结，你需要对它们进行摘要总结，最后输出一篇完整的摘要总结，用列表的形式输出。\n"
+MERGE_SEPARATOR = "\n----------------\n\n"
+# 逐层合并时中间结果的长度上限，最后一次合并不限制
+MERGE_MAX_TOKENS = 800
+
+# 可以按会话单独设置的配置，指令中的名称到会话状态字段
+SESSION_SETTINGS = {
+    "频率": "rate_limit",
+    "段数": "max_chunks",
+    "预算": "token_budget",
+}
+# 会话单独设置的token预算在prompt之外至少留给聊天记录的token数
+MIN_RECORD_TOKENS = 500
+
 
 def find_json(json_string):
     json_pattern = re.compile(r"\{[\s\S]*\}")
@@ -61,21 +89,45 @@ def find_json(json_string):
                   version="0.0.2",
                   author="sineom")
 class Summary(Plugin):
-    def __init__(self):
+    # config、db、bot一般不传，由插件自行加载；压测等场景可以传入替身
+    def __init__(self, config=None, db=None, bot=None):
         super().__init__()
-        self.config = super().load_config()
+        self.config = config or super().load_config()
         if not self.config:
             # 未加载到配置，使用模板中的配置
             self.config = self._load_config_template()
         logger.info(f"[summary] inited, config={self.config}")
-        self.db = Db()
-        save_time = self.config.get("save_time", -1)
-        if save_time > 0:
+        self.db = db or Db(flush_batch_size=self.config.get("flush_batch_size", 100),
+                           flush_interval=self.config.get("flush_interval", 2),
+                           compress_threshold=self.config.get("compress_threshold", 1024),
+                           busy_timeout=self.config.get("busy_timeout", 5000),
+                           storage=self.config.get("storage", "single"),
+                           shards=self.config.get("storage_shards", 8))
+        self.retention = RetentionEngine(self.db, self.config)
+        self.reducer = MessageReducer(self.config)
+        if bot is None:
+            btype = Bridge().btype['chat']
+            if btype not in [const.OPEN_AI, const.CHATGPT, const.CHATGPTONAZURE, const.LINKAI, const.MOONSHOT]:
+                raise Exception("[Summary] init failed, not supported bot type")
+            bot = bot_factory.create_bot(Bridge().btype['chat'])
+        self.bot = bot
+        # 异步总结任务，key为(session_id, 关键字)，value为等待结果的(channel, context)列表
+        self._jobs = {}
+        self._jobs_lock = threading.Lock()
+        # 每个会话的总结锁，避免后台预先总结和总结指令同时总结同一会话
+        self._session_locks = {}
+        self._session_locks_lock = threading.Lock()
+        self._job_executor = ThreadPoolExecutor(max_workers=self.config.get("async_workers", 2),
+                                                thread_name_prefix="summary-job")
+        self.metrics = SummaryMetrics(window=self.config.get("metrics_window", 20),
+                                      metrics_file=self.config.get("metrics_file"))
+        # 模型翻译指令的结果缓存
+        self._translate_cache = OrderedDict()
+        self._translate_lock = threading.Lock()
+        # 预先总结的结果保存在分段摘要缓存中，关闭缓存时没有意义
+        self.presummary = self.config.get("presummary", False) and self.config.get("summary_cache", True)
+        if self.retention.enabled() or self.presummary:
             self._setup_scheduler()
-        btype = Bridge().btype['chat']
-        if btype not in [const.OPEN_AI, const.CHATGPT, const.CHATGPTONAZURE, const.LINKAI, const.MOONSHOT]:
-            raise Exception("[Summary] init failed, not supported bot type")
-        self.bot = bot_factory.create_bot(Bridge().btype['chat'])
         self.handlers[Event.ON_HANDLE_CONTEXT] = self.on_handle_context
         self.handlers[Event.ON_RECEIVE_MESSAGE] = self.on_receive_message
         logger.info("[Summary] inited")
@@ -95,28 +147,29 @@ class Summary(Plugin):
         # 创建调度器
         self.scheduler = BackgroundScheduler()
 
-        # 清理旧记录的函数
-        def clean_old_records():
-            # 配置文件单位分钟，转换为秒
-            save_time = self.config.get("save_time", 12 * 60) * 60
-            self.db.delete_records(int(time.time()) - save_time)
-
-        # 设置定时任务，每天凌晨12点执行
-        self.scheduler.add_job(clean_old_records, 'cron', hour=00, minute=00)
+        if self.retention.enabled():
+            # 定期小批量清理旧记录，首次清理延后执行，不阻塞插件初始化
+            interval = self.config.get("retention_interval", 10)
+            self.scheduler.add_job(self.retention.run, 'interval', minutes=interval, max_instances=1, coalesce=True,
+                                   next_run_time=datetime.now() + timedelta(seconds=30))
+            logger.info("Cleaning old records every %d minutes." % interval)
+        if self.presummary:
+            interval = self.config.get("presummary_interval", 10)
+            self.scheduler.add_job(self._presummarize, 'interval', minutes=interval, max_instances=1, coalesce=True,
+                                   next_run_time=datetime.now() + timedelta(seconds=60))
+            logger.info("Presummarizing active sessions every %d minutes." % interval)
         # 启动调度器
         self.scheduler.start()
-        clean_old_records()
-        logger.info("Scheduler started. Cleaning old records every day at midnight.")
+        logger.info("Scheduler started.")
 
     def on_receive_message(self, e_context: EventContext):
         context = e_context['context']
         cmsg: ChatMessage = e_context['context']['msg']
-        username = None
-        session_id = cmsg.from_user_id
-        if conf().get('channel_type', 'wx') == 'wx' and cmsg.from_user_nickname is not None:
-            session_id = cmsg.from_user_nickname  # itchat channel id会变动，只好用群名作为session id
+        matcher = get_matcher(self.config.get("keyword_automaton_threshold", 16))
+        session_id = matcher.session_id(cmsg.from_user_id, cmsg.from_user_nickname)
 
-        if context.get("isgroup", False):
+        is_group = context.get("isgroup", False)
+        if is_group:
             username = cmsg.actual_user_nickname
             if username is None:
                 username = cmsg.actual_user_id
@@ -125,93 +178,188 @@ class Summary(Plugin):
             if username is None:
                 username = cmsg.from_user_id
 
-        is_triggered = False
-        content = context.content
-        if context.get("isgroup", False):  # 群聊
-            # 校验关键字
-            match_prefix = check_prefix(content, conf().get('group_chat_prefix'))
-            match_contain = check_contain(content, conf().get('group_chat_keyword'))
-            if match_prefix is not None or match_contain is not None:
-                is_triggered = True
-            if context['msg'].is_at and not conf().get("group_at_off", False):
-                is_triggered = True
-        else:  # 单聊
-            match_prefix = check_prefix(content, conf().get('single_chat_prefix', ['']))
-            if match_prefix is not None:
-                is_triggered = True
-
+        # 校验前缀和关键字，群聊中@机器人也视为触发
+        is_triggered = matcher.is_triggered(context.content, is_group, is_group and cmsg.is_at)
         self.db.insert_record(session_id, cmsg.msg_id, username, context.content, str(context.type), cmsg.create_time,
                               int(is_triggered))
         # logger.debug("[Summary] {}:{} ({})" .format(username, context.content, session_id))
 
-    def _check_tokens(self, records, max_tokens=5200):
+    def _build_session(self, records):
         query = ""
         for record in records[::-1]:
-            username = record[2]
-            content = record[3]
-            is_triggered = record[6]
-            if record[4] in [str(ContextType.IMAGE), str(ContextType.VOICE)]:
-                content = f"[{record[4]}]"
-
-            sentence = ""
-            sentence += f'{username}' + ": \"" + content + "\""
-            if is_triggered:
-                sentence += " <T>"
-            query += "\n\n" + sentence
+            query += record_sentence(record[2], record[3], record[6])
         prompt = ("你是一位群聊机器人，需要对聊天记录进行简明扼要的总结，用列表的形式输出。\n聊天记录格式：["
                   "x]是emoji表情或者是对图片和声音文件的说明，消息最后出现<T>表示消息触发了群聊机器人的回复，内容通常是提问，若带有特殊符号如#和$"
                   "则是触发你无法感知的某个插件功能，聊天记录中不包含你对这类消息的回复，可降低这些消息的权重。请不要在回复中包含聊天记录格式中出现的符号。\n")
 
-        firstmsg_id = records[0][1]
-        session = self.bot.sessions.build_session(firstmsg_id, prompt)
+        # 每段都是独立的一次性会话，不能以消息id或固定id复用bot的会话，否则并发的总结会互相覆盖
+        session = self.bot.sessions.build_session(None, prompt)
 
         session.add_query("需要你总结的聊天记录如下：%s" % query)
+        return session
+
+    def _check_tokens(self, records, max_tokens=5200):
+        session = self._build_session(records)
         if session.calc_tokens() > max_tokens:
             # logger.debug("[Summary] summary failed, tokens: %d" % session.calc_tokens())
             return None
         return session
 
-    def _split_messages_to_summarys(self, records, max_tokens_persession=3600, max_summarys=8):
-        summarys = []
-        count = 0
-        self.bot.args["max_tokens"] = 400
-        while len(records) > 0 and len(summarys) < max_summarys:
-            session = self._check_tokens(records, max_tokens_persession)
-            last = 0
-            if session is None:
-                left, right = 0, len(records)
-                while left < right:
-                    mid = (left + right) // 2
-                    logger.debug("[Summary] left: %d, right: %d, mid: %d" % (left, right, mid))
-                    session = self._check_tokens(records[:mid], max_tokens_persession)
-                    if session is None:
-                        right = mid - 1
-                    else:
-                        left = mid + 1
-                session = self._check_tokens(records[:left - 1], max_tokens_persession)
-                last = left
-                logger.debug("[Summary] summary %d messages" % left)
-            else:
-                last = len(records)
-                logger.debug("[Summary] summary all %d messages" % (len(records)))
+    # 单条记录的token数，优先使用入库时保存的值
+    @staticmethod
+    def _record_cost(record):
+        if len(record) > 7 and record[7] is not None:
+            return record[7]
+        return record_tokens(record[2], record[3], record[6])
+
+    # 超出单段预算的记录按比例截断内容，估算值留一成余量
+    @classmethod
+    def _fit_record(cls, record, budget):
+        cost = cls._record_cost(record)
+        content = record[3] or ""
+        while cost > budget and content:
+            content = content[:len(content) * budget * 9 // 10 // cost]
+            truncated = content + TRUNCATED_MARK
+            record = record[:3] + (truncated,) + record[4:7] + (record_tokens(record[2], truncated, record[6]),)
+            cost = record[7]
+        return record
+
+    # 根据每条记录的token数前缀和切分出每段的边界，每段只做一次完整的分词校验
+    def _plan_chunks(self, records, max_tokens_persession, max_summarys):
+        overhead = self._build_session([]).calc_tokens()
+        budget = max_tokens_persession - overhead
+        # 单条记录超出预算时截断，否则切分会在这条记录处中止，更早的记录都无法总结
+        records = [self._fit_record(record, budget) for record in records]
+        prefix = list(itertools.accumulate((self._record_cost(r) for r in records), initial=0))
+        chunks = []
+        start = 0
+        while start < len(records) and len(chunks) < max_summarys:
+            end = bisect.bisect_right(prefix, prefix[start] + budget, lo=start) - 1
+            if end <= start:
+                logger.debug("[Summary] record too long to summary, msgid: %s" % records[start][1])
+                break
+            # 估算值与实际分词可能略有偏差，超出时逐步收缩，通常一次即可通过
+            session = self._check_tokens(records[start:end], max_tokens_persession)
+            while session is None and end - start > 1:
+                end = start + max(1, (end - start) * 9 // 10)
+                session = self._check_tokens(records[start:end], max_tokens_persession)
             if session is None:
                 logger.debug("[Summary] summary failed, session is None")
                 break
-            logger.debug("[Summary] session query: %s, prompt_tokens: %d" % (session.messages, session.calc_tokens()))
-            result = self.bot.reply_text(session)
-            total_tokens, completion_tokens, reply_content = result['total_tokens'], result['completion_tokens'], \
-                result['content']
-            logger.debug("[Summary] total_tokens: %d, completion_tokens: %d, reply_content: %s" % (
-                total_tokens, completion_tokens, reply_content))
-            if completion_tokens == 0:
-                if len(summarys) == 0:
-                    return count, reply_content
+            logger.debug("[Summary] summary %d messages" % (end - start))
+            chunks.append((start, end, session))
+            start = end
+        return chunks
+
+    # 一段聊天记录的内容指纹，任意一条消息变化都会导致缓存失效
+    @staticmethod
+    def _chunk_hash(records):
+        digest = hashlib.sha1()
+        for record in records:
+            digest.update("\x1f".join(str(field) for field in record[1:7]).encode("utf-8"))
+            digest.update(b"\x1e")
+        return digest.hexdigest()
+
+    # 找出已被缓存覆盖且内容未变化的区间，返回 {起始下标: (结束下标, 摘要)}
+    def _find_cached_chunks(self, session_id, records):
+        if not records:
+            return {}
+        positions = {record[1]: i for i, record in enumerate(records)}
+        covered = [False] * len(records)
+        cached = {}
+        for start_msgid, end_msgid, content_hash, summary, msg_count in \
+                self.db.get_summary_cache(session_id, records[-1][5]):
+            # records按时间倒序，最新的一条消息下标最小
+            start, last = positions.get(end_msgid), positions.get(start_msgid)
+            if start is None or last is None or last - start + 1 != msg_count:
+                continue
+            if any(covered[start:last + 1]) or self._chunk_hash(records[start:last + 1]) != content_hash:
+                continue
+            covered[start:last + 1] = [True] * msg_count
+            cached[start] = (last + 1, summary)
+        return cached
+
+    # 复制一个只修改了请求参数的bot，避免并发的总结任务互相覆盖self.bot.args
+    def _bot_with_args(self, **kwargs):
+        bot = copy.copy(self.bot)
+        bot.args = dict(getattr(self.bot, "args", None) or {}, **kwargs)
+        return bot
+
+    def _summary_chunk(self, session, bot, trace: SummaryTrace, stage="map"):
+        logger.debug("[Summary] session query: %s, prompt_tokens: %d" % (session.messages, session.calc_tokens()))
+        begin = time.perf_counter()
+        result = bot.reply_text(session)
+        total_tokens, completion_tokens, reply_content = result['total_tokens'], result['completion_tokens'], \
+            result['content']
+        trace.llm_call(stage, time.perf_counter() - begin, total_tokens - completion_tokens, completion_tokens)
+        logger.debug("[Summary] total_tokens: %d, completion_tokens: %d, reply_content: %s" % (
+            total_tokens, completion_tokens, reply_content))
+        return completion_tokens, reply_content
+
+    def _split_messages_to_summarys(self, records, max_tokens_persession=3600, max_summarys=None, session_id=None,
+                                    trace: SummaryTrace = None, use_cache=True):
+        summarys = []
+        count = 0
+        # 不限制段数时每条记录最多一段
+        max_summarys = max_summarys or len(records)
+        bot = self._bot_with_args(max_tokens=400)
+        trace = trace or self.metrics.trace(session_id)
+        use_cache = use_cache and session_id is not None and self.config.get("summary_cache", True)
+        with trace.stage("cache"):
+            cached = self._find_cached_chunks(session_id, records) if use_cache else {}
+        # 已缓存的区间直接复用摘要，其余区间按token预算切分后请求模型
+        chunks = []
+        start = 0
+        while start < len(records) and len(chunks) < max_summarys:
+            if start in cached:
+                end, summary = cached[start]
+                chunks.append((start, end, None, summary))
+                start = end
+                continue
+            gap_end = min([i for i in cached if i > start], default=len(records))
+            with trace.stage("tokenize"):
+                planned = self._plan_chunks(records[start:gap_end], max_tokens_persession, max_summarys - len(chunks))
+            chunks.extend((start + s, start + e, session, None) for s, e, session in planned)
+            if not planned or start + planned[-1][1] < gap_end:
+                break
+            start = gap_end
+        pending = [chunk for chunk in chunks if chunk[2] is not None]
+        trace.count("chunks", len(chunks))
+        trace.count("cache_hits", len(chunks) - len(pending))
+        if cached:
+            logger.debug("[Summary] reuse %d cached summarys" % (len(chunks) - len(pending)))
+
+        concurrency = self.config.get("summary_concurrency", 1)
+        if concurrency > 1 and len(pending) > 1:
+            # 各段摘要并发请求，结果仍按切分顺序排列
+            with trace.stage("map"), ThreadPoolExecutor(max_workers=min(concurrency, len(pending)),
+                                                        thread_name_prefix="summary-map") as executor:
+                results = dict(zip((chunk[0] for chunk in pending),
+                                   executor.map(lambda chunk: self._summary_chunk(chunk[2], bot, trace), pending)))
+        else:
+            results = None
+
+        new_entries = []
+        for start, end, session, summary in chunks:
+            if session is not None:
+                if results is not None:
+                    completion_tokens, reply_content = results[start]
                 else:
-                    break
-            summary = reply_content
+                    with trace.stage("map"):
+                        completion_tokens, reply_content = self._summary_chunk(session, bot, trace)
+                # 某一段失败时只保留此前连续成功的摘要，与顺序执行时的行为一致
+                if completion_tokens == 0:
+                    if len(summarys) == 0:
+                        return count, reply_content
+                    else:
+                        break
+                summary = reply_content
+                new_entries.append((records[end - 1][1], records[start][1], self._chunk_hash(records[start:end]),
+                                    summary, end - start, records[end - 1][5], records[start][5]))
             summarys.append(summary)
-            records = records[last:]
-            count += last
+            count += end - start
+        if use_cache and new_entries:
+            self.db.save_summary_cache(session_id, new_entries, int(time.time()))
         return count, summarys
 
     def on_handle_context(self, e_context: EventContext):
@@ -226,38 +374,61 @@ class Summary(Plugin):
         if clist[0].startswith(trigger_prefix):
             limit = 99
             duration = -1
+            keywords = None
             msg: ChatMessage = e_context['context']['msg']
-            session_id = msg.from_user_id
-            if conf().get('channel_type', 'wx') == 'wx' and msg.from_user_nickname is not None:
-                session_id = msg.from_user_nickname  # itchat channel id会变动，只好用名字作为session id
+            matcher = get_matcher(self.config.get("keyword_automaton_threshold", 16))
+            session_id = matcher.session_id(msg.from_user_id, msg.from_user_nickname)
+
+            # 子指令支持"$总结开启"和"$总结 开启"两种写法，只匹配完整的子指令，避免话题中出现"开启"、"关闭"时被误判
+            summary_command = trigger_prefix + "总结"
+            if clist[0] == summary_command:
+                subcommand, args = (clist[1], clist[2:]) if len(clist) > 1 else ("", [])
+            elif clist[0].startswith(summary_command):
+                subcommand, args = clist[0][len(summary_command):], clist[1:]
+            else:
+                subcommand, args = "", []
 
             # 开启指令
-            if "开启" in clist[0]:
-                self.db.save_summary_stop(session_id)
+            if subcommand == "开启" or clist[0] in (trigger_prefix + "开启", trigger_prefix + "开启总结"):
+                self.db.set_disabled(session_id, False)
                 reply = Reply(ReplyType.TEXT, "开启成功")
                 e_context['reply'] = reply
                 e_context.action = EventAction.BREAK_PASS
                 return
 
             # 关闭指令
-            if "关闭" in clist[0]:
-                self.db.delete_summary_stop(session_id)
+            if subcommand == "关闭" or clist[0] in (trigger_prefix + "关闭", trigger_prefix + "关闭总结"):
+                self.db.set_disabled(session_id, True)
                 reply = Reply(ReplyType.TEXT, "关闭成功")
                 e_context['reply'] = reply
                 e_context.action = EventAction.BREAK_PASS
                 return
 
             if "总结" in clist[0]:
-                # 如果当前群聊在黑名单中，则不允许总结
-                if session_id in self.db.disable_group:
+                # 统计和设置指令，仅管理员可用
+                if subcommand in ["统计", "设置"]:
+                    if not self._is_admin(e_context):
+                        reply = Reply(ReplyType.ERROR, "需要管理员权限")
+                    elif subcommand == "统计":
+                        reply = Reply(ReplyType.INFO, self.metrics.session_report(session_id))
+                    else:
+                        reply = self._update_session_setting(session_id, args)
+                    e_context['reply'] = reply
+                    e_context.action = EventAction.BREAK_PASS
+                    return
+
+                state = self.db.get_session_state(session_id)
+                # 如果当前群聊已关闭总结，则不允许总结
+                if state["disabled"]:
                     logger.info("[Summary] summary stop")
                     reply = Reply(ReplyType.TEXT, "我不想总结了")
                     e_context['reply'] = reply
                     e_context.action = EventAction.BREAK_PASS
                     return
 
-                limit_time = self.config.get("rate_limit_summary", 60) * 60
-                last_time = self.db.get_summary_time(session_id)
+                rate_limit = state["rate_limit"]
+                limit_time = (rate_limit if rate_limit is not None else self.config.get("rate_limit_summary", 60)) * 60
+                last_time = state["summary_time"]
                 if last_time is not None and time.time() - last_time < limit_time:
                     logger.info("[Summary] rate limit")
                     reply = Reply(ReplyType.TEXT, "我有些累了，请稍后再试")
@@ -275,19 +446,10 @@ class Summary(Plugin):
                             flag = False
                 if not flag:
                     text = content.split(trigger_prefix, maxsplit=1)[1]
-                    try:
-                        command_json = find_json(self._translate_text_to_commands(text))
-                        command = json.loads(command_json)
-                        name = command["name"]
-                        if name.lower() == "summary":
-                            limit = int(command["args"].get("count", 99))
-                            if limit < 0:
-                                limit = 299
-                            duration = int(command["args"].get("duration_in_seconds", -1))
-                            logger.debug("[Summary] limit: %d, duration: %d seconds" % (limit, duration))
-                    except Exception as e:
-                        logger.error("[Summary] translate failed: %s" % e)
+                    command = self._parse_command(text)
+                    if command is None:
                         return
+                    limit, duration, keywords = command
             else:
                 return
 
@@ -297,67 +459,304 @@ class Summary(Plugin):
             else:
                 start_time = 0
 
-            records = self.db.get_records(session_id, start_time, limit)
-            for i in range(len(records)):
-                record = list(records[i])
-                content = record[3]
-                clist = re.split(r'\n- - - - - - - - -.*?\n', content)
-                if len(clist) > 1:
-                    record[3] = clist[1]
-                    records[i] = tuple(record)
-            if len(records) <= 1:
-                reply = Reply(ReplyType.INFO, "无聊天记录可供总结")
-                e_context['reply'] = reply
-                e_context.action = EventAction.BREAK_PASS
-                return
-
-            max_tokens_persession = 4800
-
-            count, summarys = self._split_messages_to_summarys(records, max_tokens_persession)
-            if count == 0:
-                if isinstance(summarys, str):
-                    reply = Reply(ReplyType.ERROR, summarys)
-                else:
-                    reply = Reply(ReplyType.ERROR, "总结聊天记录失败")
-                e_context['reply'] = reply
-                e_context.action = EventAction.BREAK_PASS
-                return
-
-            if len(summarys) == 1:
-                reply = Reply(ReplyType.TEXT, f"本次总结了{count}条消息。\n\n" + summarys[0])
-                e_context['reply'] = reply
-                e_context.action = EventAction.BREAK_PASS
-                self.db.save_summary_time(session_id, int(time.time()))
-                return
-
-            self.bot.args["max_tokens"] = None
-            query = ""
-            for i, summary in enumerate(reversed(summarys)):
-                query += summary + "\n----------------\n\n"
-            prompt = "你是一位群聊机器人，聊天记录已经在你的大脑中被你总结成多段摘要总结，你需要对它们进行摘要总结，最后输出一篇完整的摘要总结，用列表的形式输出。\n"
-            logger.debug("[Summary] query: %s" % query)
-
-            session = self.bot.sessions.build_session(session_id, prompt)
-            session.add_query(query)
-            result = self.bot.reply_text(session)
-            total_tokens, completion_tokens, reply_content = result['total_tokens'], result['completion_tokens'], \
-                result['content']
-            logger.debug("[Summary] total_tokens: %d, completion_tokens: %d, reply_content: %s" % (
-                total_tokens, completion_tokens, reply_content))
-            if completion_tokens == 0:
-                reply = Reply(ReplyType.ERROR, "合并摘要失败，" + reply_content + "\n原始多段摘要如下：\n" + query)
+            if self.config.get("async_summary", False):
+                reply = self._submit_summary_job(session_id, start_time, limit, e_context, keywords)
             else:
-                reply = Reply(ReplyType.TEXT, f"本次总结了{count}条消息。\n\n" + reply_content)
+                reply = self._summarize(session_id, start_time, limit, keywords)
             e_context['reply'] = reply
             e_context.action = EventAction.BREAK_PASS  # 事件结束，并跳过处理context的默认逻辑
-            self.db.save_summary_time(session_id, int(time.time()))
+
+    # 设置当前会话单独的配置，如"$总结 设置 频率 30"，值为"默认"时恢复全局配置
+    def _update_session_setting(self, session_id, args):
+        if len(args) != 2 or args[0] not in SESSION_SETTINGS:
+            return Reply(ReplyType.ERROR, "用法：设置 <%s> <数值|默认>" % "|".join(SESSION_SETTINGS))
+        field = SESSION_SETTINGS[args[0]]
+        if args[1] == "默认":
+            value = None
+        else:
+            try:
+                value = int(args[1])
+            except ValueError:
+                return Reply(ReplyType.ERROR, "设置的值需要是整数")
+            if value <= 0:
+                return Reply(ReplyType.ERROR, "设置的值需要是正整数")
+            if field == "max_chunks" and value < 2:
+                return Reply(ReplyType.ERROR, "段数不能小于2")
+            if field == "token_budget":
+                min_budget = self._build_session([]).calc_tokens() + MIN_RECORD_TOKENS
+                if value < min_budget:
+                    return Reply(ReplyType.ERROR, "预算不能小于%d" % min_budget)
+        self.db.set_session_state(session_id, field, value)
+        return Reply(ReplyType.INFO, "设置成功")
+
+    @staticmethod
+    def _is_admin(e_context: EventContext):
+        context = e_context['context']
+        msg: ChatMessage = context['msg']
+        user_id = msg.actual_user_id if context.get("isgroup", False) else msg.from_user_id
+        return user_id in global_config.get("admin_users", [])
+
+    # 异步总结：立即回复，总结完成后通过channel发送结果；同一会话同一话题同时只运行一个任务，后来的请求共享该任务的结果
+    def _submit_summary_job(self, session_id, start_time, limit, e_context: EventContext, keywords=None):
+        waiter = (e_context['channel'], e_context['context'])
+        key = (session_id, tuple(keywords or ()))
+        with self._jobs_lock:
+            waiters = self._jobs.get(key)
+            if waiters is not None:
+                waiters.append(waiter)
+                logger.info("[Summary] summary job of %s is running, join it" % session_id)
+                return Reply(ReplyType.INFO, "正在总结中，完成后会一并发送结果")
+            self._jobs[key] = [waiter]
+        self._job_executor.submit(self._run_summary_job, key, start_time, limit)
+        return Reply(ReplyType.INFO, "收到，正在总结聊天记录，请稍候")
+
+    def _run_summary_job(self, key, start_time, limit):
+        session_id, keywords = key
+        try:
+            reply = self._summarize(session_id, start_time, limit, list(keywords) or None)
+        except Exception as e:
+            logger.exception(e)
+            reply = Reply(ReplyType.ERROR, "总结聊天记录失败")
+        finally:
+            with self._jobs_lock:
+                waiters = self._jobs.pop(key, [])
+        for channel, context in waiters:
+            try:
+                channel.send(reply, context)
+            except Exception as e:
+                logger.error("[Summary] send summary reply failed: %s" % e)
+
+    # 总结指定会话的聊天记录，指定关键字时只总结相关的消息及其上下文，成功时记录总结时间
+    def _summarize(self, session_id, start_time, limit, keywords=None) -> Reply:
+        trace = self.metrics.trace(session_id)
+        try:
+            with self._session_lock(session_id):
+                return self._summarize_records(session_id, start_time, limit, trace, keywords)
+        finally:
+            trace.finish()
+
+    def _session_lock(self, session_id):
+        with self._session_locks_lock:
+            return self._session_locks.setdefault(session_id, threading.Lock())
+
+    def _summarize_records(self, session_id, start_time, limit, trace: SummaryTrace, keywords=None) -> Reply:
+        # limit为None时总结时间范围内的全部消息，以max_range_records为上限，多取一条用于判断是否超出
+        range_limit = None
+        if limit is None:
+            range_limit = limit = self.config.get("max_range_records", 50000)
+        with trace.stage("db"):
+            if keywords:
+                records = self.db.search_records(session_id, keywords, start_time, limit,
+                                                 self.config.get("topic_context", 2))
+            else:
+                records = self.db.get_records(session_id, start_time, limit + 1 if range_limit else limit)
+        truncated = range_limit is not None and not keywords and len(records) > range_limit
+        if truncated:
+            records = records[:range_limit]
+        if keywords and not records:
+            return Reply(ReplyType.INFO, "没有找到与“%s”相关的聊天记录" % "、".join(keywords))
+        if len(records) <= 1:
+            return Reply(ReplyType.INFO, "无聊天记录可供总结")
+
+        # 切分前先精简记录，sources为精简后每条记录对应的原始消息数
+        with trace.stage("reduce"):
+            reduced, sources, saved = self.reducer.reduce(records)
+        trace.count("reduce_saved_tokens", saved)
+        logger.debug("[Summary] reduce %d records to %d, saved %d tokens" % (len(records), len(reduced), saved))
+        if not reduced:
+            return Reply(ReplyType.INFO, "无聊天记录可供总结")
+
+        max_tokens_persession, max_summarys = self._chunk_limits(session_id)
+
+        # 所有记录都参与分段，段数不设上限，由逐层合并保证每次请求的大小
+        # 按话题筛选出的记录不连续，其分段摘要不会被完整总结复用，不写入缓存
+        count, summarys = self._split_messages_to_summarys(reduced, max_tokens_persession, None,
+                                                           session_id=session_id, trace=trace,
+                                                           use_cache=not keywords)
+        if count == 0:
+            if isinstance(summarys, str):
+                return Reply(ReplyType.ERROR, summarys)
+            return Reply(ReplyType.ERROR, "总结聊天记录失败")
+        # 已总结的是最新的count条精简记录，换算为原始消息数
+        omitted = sum(sources[count:])
+        count = sum(sources[:count])
+
+        summary = summarys[0]
+        if len(summarys) > 1:
+            merged, summary = self._merge_summarys(summarys, max_tokens_persession, max_summarys, trace)
+            if not merged:
+                self.db.save_summary_time(session_id, int(time.time()))
+                return Reply(ReplyType.ERROR, summary)
+        self.db.save_summary_time(session_id, int(time.time()))
+        header = f"本次总结了{count}条消息。"
+        if truncated:
+            header += f"时间范围内的消息超过{range_limit}条，只总结了最新的{range_limit}条。"
+        if omitted:
+            header += f"另有{omitted}条较早的消息未能总结。"
+        return Reply(ReplyType.TEXT, header + "\n\n" + summary)
+
+    # 多段摘要按时间正序拼接，summarys与切分结果一致，最新的在前
+    @staticmethod
+    def _merge_query(summarys):
+        return "".join(summary + MERGE_SEPARATOR for summary in reversed(summarys))
+
+    # 按顺序把摘要分组，每组不超过max_summarys段且不超过token预算；每组至少两段，保证每一层都在减少
+    def _plan_merges(self, summarys, max_tokens_persession, max_summarys):
+        budget = max_tokens_persession - num_tokens(MERGE_PROMPT)
+        batches = []
+        batch, used = [], 0
+        for summary in summarys:
+            cost = num_tokens(summary + MERGE_SEPARATOR)
+            if len(batch) >= 2 and (used + cost > budget or len(batch) >= max_summarys):
+                batches.append(batch)
+                batch, used = [], 0
+            batch.append(summary)
+            used += cost
+        batches.append(batch)
+        return batches
+
+    # 逐层合并多段摘要直到只剩一段，同一层的各组可以并发请求；返回(是否成功, 摘要或错误信息)
+    def _merge_summarys(self, summarys, max_tokens_persession, max_summarys, trace: SummaryTrace):
+        levels = 0
+        while len(summarys) > 1:
+            batches = self._plan_merges(summarys, max_tokens_persession, max(2, max_summarys))
+            bot = self._bot_with_args(max_tokens=None if len(batches) == 1 else MERGE_MAX_TOKENS)
+            levels += 1
+            logger.debug("[Summary] merge %d summarys in %d batches" % (len(summarys), len(batches)))
+
+            def merge(batch):
+                # 只剩一段的组直接进入下一层
+                if len(batch) == 1:
+                    return None, batch[0]
+                session = self.bot.sessions.build_session(None, MERGE_PROMPT)
+                session.add_query(self._merge_query(batch))
+                return self._summary_chunk(session, bot, trace, "merge")
+
+            concurrency = self.config.get("summary_concurrency", 1)
+            with trace.stage("merge"):
+                if concurrency > 1 and len(batches) > 1:
+                    with ThreadPoolExecutor(max_workers=min(concurrency, len(batches)),
+                                            thread_name_prefix="summary-merge") as executor:
+                        results = list(executor.map(merge, batches))
+                else:
+                    results = [merge(batch) for batch in batches]
+            for completion_tokens, reply_content in results:
+                if completion_tokens == 0:
+                    trace.count("merge_levels", levels)
+                    # 段数较少时附上未合并的摘要，太多时回复不下
+                    if len(summarys) > max_summarys:
+                        return False, "合并摘要失败，" + reply_content
+                    return False, "合并摘要失败，" + reply_content + "\n原始多段摘要如下：\n" + self._merge_query(summarys)
+            summarys = [reply_content for _, reply_content in results]
+        trace.count("merge_levels", levels)
+        return True, summarys[0]
+
+    # 每段的token预算和每次最多合并的段数，会话单独的配置优先
+    def _chunk_limits(self, session_id):
+        state = self.db.get_session_state(session_id)
+        max_tokens_persession = state["token_budget"] or self.config.get("max_tokens_persession", 4800)
+        max_summarys = state["max_chunks"] or self.config.get("max_summarys", 8)
+        return max_tokens_persession, max_summarys
+
+    # 后台预先总结：找出最新一段摘要之后新消息足够多的会话，分段总结后写入分段摘要缓存，
+    # 之后的总结指令直接复用这些摘要，只需再总结最新的少量消息并合并
+    def _presummarize(self):
+        with self._jobs_lock:
+            busy = bool(self._jobs)
+        if busy:
+            logger.debug("[Summary] summary jobs are running, skip presummary")
+            return
+        now = int(time.time())
+        # 最近一段时间仍在活跃的消息留到下次，避免刚总结完又因新消息导致最后一段失效
+        end_time = now - self.config.get("presummary_idle_seconds", 300)
+        start_time = now - self.config.get("presummary_window", 1440) * 60
+        sessions = self.db.pending_sessions(start_time, end_time, self.config.get("presummary_min_messages", 50),
+                                            self.config.get("presummary_max_sessions", 5))
+        # 按本轮的token预算挑选会话，每个会话的花费按精简后的记录估算
+        budget = self.config.get("presummary_token_budget", 20000)
+        selected = []
+        for session_id, pending, digested in sessions:
+            if self.db.is_disabled(session_id):
+                continue
+            records = [record for record in self.db.get_records(session_id, max(digested or 0, start_time))
+                       if record[5] <= end_time]
+            records, _, _ = self.reducer.reduce(records)
+            max_tokens_persession, _ = self._chunk_limits(session_id)
+            # 预算不足以总结全部新消息时，只总结最新的几段
+            max_chunks = budget // max_tokens_persession
+            if not records or max_chunks == 0:
+                continue
+            budget -= min(sum(self._record_cost(record) for record in records), max_tokens_persession * max_chunks)
+            selected.append((session_id, records, max_chunks))
+        if not selected:
+            return
+        logger.info("[Summary] presummary %d sessions" % len(selected))
+        with ThreadPoolExecutor(max_workers=self.config.get("presummary_concurrency", 1),
+                                thread_name_prefix="summary-pre") as executor:
+            list(executor.map(lambda item: self._presummarize_session(*item), selected))
+
+    def _presummarize_session(self, session_id, records, max_chunks):
+        lock = self._session_lock(session_id)
+        if not lock.acquire(blocking=False):
+            logger.debug("[Summary] %s is being summarized, skip presummary" % session_id)
+            return
+        max_tokens_persession, _ = self._chunk_limits(session_id)
+        # 不调用finish，后台任务不计入会话的总结统计
+        trace = self.metrics.trace(session_id)
+        try:
+            count, _ = self._split_messages_to_summarys(records, max_tokens_persession, max_chunks,
+                                                        session_id=session_id, trace=trace)
+        except Exception as e:
+            logger.exception(e)
+            return
+        finally:
+            lock.release()
+        logger.info("[Summary] presummary %s: %d records, %d llm calls, %d prompt tokens" % (
+            session_id, count, len(trace.llm_calls), sum(call[2] for call in trace.llm_calls)))
+
+    # 解析总结指令，返回(limit, duration, keywords)；先本地解析，解析不了再请求模型翻译，翻译结果做LRU缓存
+    def _parse_command(self, text):
+        args = parse_summary_command(text)
+        if args is None:
+            key = " ".join(text.split())
+            with self._translate_lock:
+                args = self._translate_cache.get(key)
+                if args is not None:
+                    self._translate_cache.move_to_end(key)
+            if args is None:
+                try:
+                    command = json.loads(find_json(self._translate_text_to_commands(text)))
+                    args = command["args"] if command["name"].lower() == "summary" else {}
+                except Exception as e:
+                    logger.error("[Summary] translate failed: %s" % e)
+                    return None
+                with self._translate_lock:
+                    self._translate_cache[key] = args
+                    while len(self._translate_cache) > self.config.get("translate_cache_size", 128):
+                        self._translate_cache.popitem(last=False)
+        duration = int(args.get("duration_in_seconds", -1))
+        # 只指定时间范围时总结该范围内的全部消息，limit为None
+        if "count" not in args and duration > 0:
+            limit = None
+        else:
+            limit = int(args.get("count", 99))
+            if limit < 0:
+                limit = 299
+        keywords = args.get("keywords") or None
+        if isinstance(keywords, str):
+            keywords = [keywords]
+        if keywords:
+            keywords = [str(keyword).strip() for keyword in keywords if str(keyword).strip()] or None
+        logger.debug("[Summary] limit: %s, duration: %d seconds, keywords: %s" % (limit, duration, keywords))
+        return limit, duration, keywords
 
     def _translate_text_to_commands(self, text):
         # 随机的session id
         session_id = str(time.time())
         session = self.bot.sessions.build_session(session_id, system_prompt=TRANSLATE_PROMPT)
         session.add_query(text)
-        content = self.bot.reply_text(session)
+        result = self.bot.reply_text(session)
+        content = result['content']
         logger.debug("_translate_text_to_commands: %s" % content)
         return content
 
@@ -366,5 +765,5 @@ class Summary(Plugin):
         if not verbose:
             return help_text
         trigger_prefix = conf().get('plugin_trigger_prefix', "$")
-        help_text += f"使用方法:输入\"{trigger_prefix}总结 最近消息数量\"，我会帮助你总结聊天记录。\n例如：\"{trigger_prefix}总结 100\"，我会总结最近100条消息。\n\n你也可以直接输入\"{trigger_prefix}总结前99条信息\"或\"{trigger_prefix}总结3小时内的最近10条消息\"\n我会尽可能理解你的指令。"
+        help_text += f"使用方法:输入\"{trigger_prefix}总结 最近消息数量\"，我会帮助你总结聊天记录。\n例如：\"{trigger_prefix}总结 100\"，我会总结最近100条消息。\n\n你也可以直接输入\"{trigger_prefix}总结前99条信息\"或\"{trigger_prefix}总结3小时内的最近10条消息\"\n我会尽可能理解你的指令。\n\n只想了解某个话题时可以输入\"{trigger_prefix}总结关于发布的讨论\"，我只会总结提到该话题的消息及其上下文。"
         return help_text
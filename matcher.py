@@ -0,0 +1,116 @@
+# encoding:utf-8
+"""
+消息触发判断：根据全局配置预先构建前缀和关键字匹配器，只在配置重新加载后重建
+"""
+from collections import deque
+
+from config import conf
+
+
+class KeywordAutomaton:
+    """
+    Aho-Corasick多模式匹配，一次遍历判断文本中是否包含任意关键字
+    """
+
+    def __init__(self, keywords):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [False]
+        for keyword in keywords:
+            self._add(keyword)
+        self._build()
+
+    def _add(self, keyword):
+        node = 0
+        for char in keyword:
+            nxt = self.goto[node].get(char)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto[node][char] = nxt
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append(False)
+            node = nxt
+        self.output[node] = True
+
+    def _build(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, nxt in self.goto[node].items():
+                queue.append(nxt)
+                fail = self.fail[node]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[nxt] = self.goto[fail].get(char, 0)
+                self.output[nxt] = self.output[nxt] or self.output[self.fail[nxt]]
+
+    def search(self, text):
+        goto, fail, output = self.goto, self.fail, self.output
+        node = 0
+        for char in text:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if output[node]:
+                return True
+        return False
+
+
+class TriggerMatcher:
+    """
+    判断一条消息是否会触发机器人回复，结果与channel.chat_channel中的check_prefix/check_contain一致
+    """
+
+    def __init__(self, config, automaton_threshold=16):
+        self.config = config
+        self.group_prefixes = tuple(config.get('group_chat_prefix') or ())
+        self.single_prefixes = tuple(config.get('single_chat_prefix', ['']) or ())
+        self.group_at_off = config.get("group_at_off", False)
+        # itchat channel id会变动，只好用群名作为session id
+        self.use_nickname = config.get('channel_type', 'wx') == 'wx'
+
+        keywords = [keyword for keyword in (config.get('group_chat_keyword') or []) if keyword is not None]
+        self.keywords = tuple(keywords)
+        self.any_keyword = "" in keywords
+        self.automaton_threshold = automaton_threshold
+        self.automaton = KeywordAutomaton(keywords) if len(keywords) >= automaton_threshold else None
+
+    def session_id(self, from_user_id, from_user_nickname):
+        if self.use_nickname and from_user_nickname is not None:
+            return from_user_nickname
+        return from_user_id
+
+    def _contains_keyword(self, content):
+        if self.any_keyword:
+            return True
+        if self.automaton is not None:
+            return self.automaton.search(content)
+        for keyword in self.keywords:
+            if keyword in content:
+                return True
+        return False
+
+    def is_triggered(self, content, is_group, is_at=False):
+        content = content or ""
+        if is_group:
+            if self.group_prefixes and content.startswith(self.group_prefixes):
+                return True
+            if self.keywords and self._contains_keyword(content):
+                return True
+            return bool(is_at) and not self.group_at_off
+        return bool(self.single_prefixes) and content.startswith(self.single_prefixes)
+
+
+_matcher = None
+
+
+# 当前配置对应的匹配器，配置重新加载后conf()返回新对象或阈值变化时重建
+def get_matcher(automaton_threshold=16) -> TriggerMatcher:
+    global _matcher
+    config = conf()
+    matcher = _matcher
+    if matcher is None or matcher.config is not config or matcher.automaton_threshold != automaton_threshold:
+        matcher = TriggerMatcher(config, automaton_threshold)
+        _matcher = matcher
+    return matcher
@@ -0,0 +1,159 @@
+# encoding:utf-8
+"""
+总结流程各环节的耗时和token统计，按会话保留最近若干次的记录，可选输出Prometheus文本格式的指标文件
+"""
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+from common.log import logger
+
+STAGES = ["db", "reduce", "tokenize", "cache", "map", "merge"]
+
+
+class SummaryTrace:
+    """一次总结请求的统计，map阶段可能在多个线程中并发记录"""
+
+    def __init__(self, metrics, session_id):
+        self.metrics = metrics
+        self.session_id = session_id
+        self.start = time.perf_counter()
+        self.stages = defaultdict(float)
+        self.llm_calls = []
+        self.counters = defaultdict(int)
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        begin = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.stages[name] += time.perf_counter() - begin
+
+    def llm_call(self, stage, seconds, prompt_tokens, completion_tokens):
+        with self.lock:
+            self.llm_calls.append((stage, seconds, prompt_tokens, completion_tokens))
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def finish(self):
+        self.metrics.record(self, time.perf_counter() - self.start)
+
+
+class SummaryMetrics:
+    def __init__(self, window=20, metrics_file=None):
+        self.window = window
+        self.metrics_file = metrics_file
+        self.sessions = defaultdict(lambda: deque(maxlen=self.window))
+        # 累计值，用于输出Prometheus计数器
+        self.totals = defaultdict(float)
+        self.lock = threading.Lock()
+
+    def trace(self, session_id) -> SummaryTrace:
+        return SummaryTrace(self, session_id)
+
+    def record(self, trace: SummaryTrace, seconds):
+        sample = {
+            "seconds": seconds,
+            "stages": dict(trace.stages),
+            "llm_calls": len(trace.llm_calls),
+            "llm_seconds": sum(call[1] for call in trace.llm_calls),
+            "prompt_tokens": sum(call[2] for call in trace.llm_calls),
+            "completion_tokens": sum(call[3] for call in trace.llm_calls),
+            "counters": dict(trace.counters),
+        }
+        with self.lock:
+            self.sessions[trace.session_id].append(sample)
+            self.totals["requests"] += 1
+            self.totals["seconds"] += seconds
+            for stage, value in trace.stages.items():
+                self.totals["stage_seconds:" + stage] += value
+            for stage, call_seconds, prompt_tokens, completion_tokens in trace.llm_calls:
+                self.totals["llm_calls:" + stage] += 1
+                self.totals["llm_seconds:" + stage] += call_seconds
+                self.totals["prompt_tokens:" + stage] += prompt_tokens
+                self.totals["completion_tokens:" + stage] += completion_tokens
+            for name, value in trace.counters.items():
+                self.totals["counter:" + name] += value
+        logger.info("[Summary] session %s finished in %.2fs, stages: %s, llm calls: %d, tokens: %d/%d, counters: %s" % (
+            trace.session_id, seconds, {k: round(v, 3) for k, v in sample["stages"].items()}, sample["llm_calls"],
+            sample["prompt_tokens"], sample["completion_tokens"], sample["counters"]))
+        if self.metrics_file:
+            self.write_prometheus()
+
+    # 会话最近几次总结的汇总文本
+    def session_report(self, session_id):
+        with self.lock:
+            samples = list(self.sessions.get(session_id, []))
+        if not samples:
+            return "暂无总结统计"
+        n = len(samples)
+
+        def avg(values):
+            return sum(values) / n
+
+        lines = [f"最近{n}次总结统计：",
+                 "平均耗时 %.2fs，最长 %.2fs" % (avg([s["seconds"] for s in samples]),
+                                           max(s["seconds"] for s in samples))]
+        for stage in STAGES:
+            values = [s["stages"].get(stage, 0) for s in samples]
+            if any(values):
+                lines.append("- %s: 平均 %.2fs" % (stage, avg(values)))
+        lines.append("平均模型调用 %.1f 次，模型耗时 %.2fs" % (avg([s["llm_calls"] for s in samples]),
+                                                     avg([s["llm_seconds"] for s in samples])))
+        lines.append("平均token：输入 %d，输出 %d" % (avg([s["prompt_tokens"] for s in samples]),
+                                                avg([s["completion_tokens"] for s in samples])))
+        counters = defaultdict(int)
+        for s in samples:
+            for name, value in s["counters"].items():
+                counters[name] += value
+        if counters:
+            lines.append("累计：" + "，".join(f"{name} {value}" for name, value in sorted(counters.items())))
+        return "\n".join(lines)
+
+    def prometheus_text(self):
+        with self.lock:
+            totals = dict(self.totals)
+            last = {session_id: samples[-1]["seconds"] for session_id, samples in self.sessions.items() if samples}
+        lines = [
+            "# TYPE summary_requests_total counter",
+            "summary_requests_total %d" % totals.get("requests", 0),
+            "# TYPE summary_request_seconds_total counter",
+            "summary_request_seconds_total %f" % totals.get("seconds", 0),
+            "# TYPE summary_stage_seconds_total counter",
+        ]
+        for key, value in sorted(totals.items()):
+            if key.startswith("stage_seconds:"):
+                lines.append('summary_stage_seconds_total{stage="%s"} %f' % (key.split(":", 1)[1], value))
+        for metric, prefix in [("summary_llm_calls_total", "llm_calls:"),
+                               ("summary_llm_seconds_total", "llm_seconds:"),
+                               ("summary_prompt_tokens_total", "prompt_tokens:"),
+                               ("summary_completion_tokens_total", "completion_tokens:")]:
+            lines.append("# TYPE %s counter" % metric)
+            for key, value in sorted(totals.items()):
+                if key.startswith(prefix):
+                    lines.append('%s{stage="%s"} %g' % (metric, key.split(":", 1)[1], value))
+        lines.append("# TYPE summary_events_total counter")
+        for key, value in sorted(totals.items()):
+            if key.startswith("counter:"):
+                lines.append('summary_events_total{event="%s"} %d' % (key.split(":", 1)[1], value))
+        lines.append("# TYPE summary_session_last_seconds gauge")
+        for session_id, seconds in sorted(last.items()):
+            label = str(session_id).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            lines.append('summary_session_last_seconds{session="%s"} %f' % (label, seconds))
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self):
+        try:
+            tmp_path = self.metrics_file + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(self.prometheus_text())
+            os.replace(tmp_path, self.metrics_file)
+        except Exception as e:
+            logger.error("[Summary] write metrics file failed: %s" % e)
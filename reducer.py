@@ -0,0 +1,103 @@
+# encoding:utf-8
+"""
+总结前的精简：去掉插件指令和信息量低的消息，折叠刷屏和重复转发，合并同一用户的连续发言，截断超长内容
+"""
+import re
+
+from config import conf
+from plugins.plugin_summary.tokenizer import record_tokens
+
+# 只有表情、占位符、标点或"+1"、"哈哈"、"收到"之类的附和
+LOW_INFO_PATTERN = re.compile(r"^(?:\[[^\[\]\s]{1,10}\]|\+\d|[1-9]|6+|哈+|呵+|嘿+|嗯+|哦+|噢+|啊+|额+|好+的?|收到|ok|okay|"
+                              r"谢谢|多谢|赞|顶|是的|对的?|[!！?？。.,，~～…]+|\s+)+$", re.IGNORECASE)
+# 同一内容连续出现至少这么多次时标注次数，次数较少的附和直接去掉
+FLOOD_MIN_REPEAT = 3
+# 不少于该长度的内容在窗口内重复出现时视为转发，只保留第一次
+DUPLICATE_MIN_CHARS = 20
+# 合并同一用户的连续发言时使用的分隔符
+MERGE_SEPARATOR = "；"
+# 截断后的内容末尾追加的标记
+TRUNCATED_MARK = "…(已截断)"
+
+
+class MessageReducer:
+    """
+    records为get_records返回的记录，按时间倒序；返回精简后的记录、每条记录对应的原始消息数以及节省的token数
+    """
+
+    def __init__(self, config):
+        self.enabled = config.get("reduce", True)
+        self.max_chars = config.get("reduce_max_chars", 500)
+        # 同一用户两条发言间隔不超过该秒数时合并，0表示不合并
+        self.merge_gap = config.get("reduce_merge_gap", 300)
+        # 合并后的记录不超过该token数，避免长时间的独白合并成一条超出分段预算的记录
+        self.merge_max_tokens = config.get("reduce_merge_max_tokens", 500)
+
+    @staticmethod
+    def _cost(record):
+        if len(record) > 7 and record[7] is not None:
+            return record[7]
+        return record_tokens(record[2], record[3], record[6])
+
+    @staticmethod
+    def _replace(record, content, msg_type=None):
+        session_id, msg_id, user, _, old_type, timestamp, is_triggered = record[:7]
+        return (session_id, msg_id, user, content, msg_type or old_type, timestamp, is_triggered,
+                record_tokens(user, content, is_triggered))
+
+    def reduce(self, records):
+        if not self.enabled or not records:
+            return records, [1] * len(records), 0
+        prefix = conf().get("plugin_trigger_prefix", "$")
+        # 按时间正序处理，items为[记录, 原始内容, 连续重复次数, 原始消息数]；丢弃的消息计入其后保留的那一条
+        items = []
+        seen = set()
+        dropped = 0
+        for record in reversed(records):
+            content = record[3] or ""
+            # 连续的相同内容折叠为一条，保留最后一条的发送者和时间
+            if items and items[-1][1] == content:
+                item = items[-1]
+                item[0] = record[:3] + item[0][3:5] + record[5:]
+                item[2] += 1
+                item[3] += 1 + dropped
+                dropped = 0
+                continue
+            # 插件指令对总结没有意义，模型也看不到插件的回复；较长的内容再次出现时视为转发
+            if (prefix and content.startswith(prefix)) or content in seen:
+                dropped += 1
+                continue
+            if len(content) >= DUPLICATE_MIN_CHARS:
+                seen.add(content)
+            if self.max_chars > 0 and len(content) > self.max_chars:
+                record = self._replace(record, content[:self.max_chars] + TRUNCATED_MARK)
+            items.append([record, content, 1, 1 + dropped])
+            dropped = 0
+        # 最新的几条消息被丢弃时计入最后保留的那一条
+        if items:
+            items[-1][3] += dropped
+        dropped = 0
+
+        reduced = []
+        for record, content, repeats, sources in items:
+            sources += dropped
+            dropped = 0
+            if repeats >= FLOOD_MIN_REPEAT:
+                record = self._replace(record, "{}（{}人次）".format(record[3], repeats))
+            elif LOW_INFO_PATTERN.match(content):
+                dropped = sources
+                continue
+            last = reduced[-1] if reduced else None
+            if self.merge_gap > 0 and last is not None and last[0][2] == record[2] and \
+                    last[0][6] == record[6] and record[5] - last[0][5] <= self.merge_gap:
+                merged = self._replace(record, last[0][3] + MERGE_SEPARATOR + record[3], "TEXT")
+                if self._cost(merged) <= self.merge_max_tokens:
+                    reduced[-1] = [merged, last[1] + sources]
+                    continue
+            reduced.append([record, sources])
+        if reduced:
+            reduced[-1][1] += dropped
+
+        saved = sum(self._cost(record) for record in records) - sum(self._cost(record) for record, _ in reduced)
+        reduced.reverse()
+        return [record for record, _ in reduced], [sources for _, sources in reduced], saved
@@ -0,0 +1,73 @@
+# encoding:utf-8
+"""
+聊天记录清理：小批量分多次删除过期记录，避免长时间占用写锁阻塞消息入库
+"""
+import time
+
+from common.log import logger
+
+
+class RetentionEngine:
+    def __init__(self, db, config):
+        self.db = db
+        # 单位均为分钟，-1表示永久保留
+        self.save_time = config.get("save_time", -1)
+        self.session_save_time = config.get("session_save_time", {}) or {}
+        self.max_db_size = config.get("max_db_size", 0) * 1024 * 1024
+        self.batch_size = config.get("retention_batch_size", 500)
+        self.max_batches = config.get("retention_max_batches", 20)
+        self.vacuum_pages = config.get("retention_vacuum_pages", 1000)
+        # 旧库开启增量回收前需要整理一次，期间阻塞消息入库，需要显式开启
+        self.vacuum_rebuild = config.get("retention_vacuum_rebuild", False)
+
+    def enabled(self):
+        return self.save_time > 0 or self.max_db_size > 0 or \
+            any(minutes > 0 for minutes in self.session_save_time.values())
+
+    # 每次执行最多删除max_batches批记录，剩余的留到下次执行
+    def run(self):
+        start = time.time()
+        now = int(start)
+        budget = self.max_batches
+        deleted = 0
+
+        # 单独配置了保存时间的会话
+        for session_id, minutes in self.session_save_time.items():
+            if minutes <= 0:
+                continue
+            count, budget = self._sweep(now - minutes * 60, budget, session_id=session_id)
+            deleted += count
+
+        # 其余会话使用全局保存时间
+        if self.save_time > 0:
+            count, budget = self._sweep(now - self.save_time * 60, budget, exclude=tuple(self.session_save_time))
+            deleted += count
+
+        # 超出容量上限时从最早的记录开始删除
+        while self.max_db_size > 0 and budget > 0 and self.db.used_size() > self.max_db_size:
+            count = self.db.delete_oldest_records(self.batch_size)
+            budget -= 1
+            deleted += count
+            if count == 0:
+                break
+
+        if self.vacuum_rebuild and self.db.enable_incremental_vacuum():
+            # 每个库只需要整理一次
+            self.vacuum_rebuild = False
+        if deleted > 0:
+            self.db.incremental_vacuum(self.vacuum_pages)
+        logger.info("[Summary] retention deleted {} records in {:.2f}s".format(deleted, time.time() - start))
+        return deleted
+
+    def _sweep(self, cutoff, budget, session_id=None, exclude=()):
+        deleted = 0
+        while budget > 0:
+            count = self.db.delete_records(cutoff, session_id=session_id, exclude=exclude, limit=self.batch_size)
+            budget -= 1
+            deleted += count
+            if count < self.batch_size:
+                break
+            # 批次之间让出写锁，入库可以插队
+            time.sleep(0.01)
+        self.db.delete_summary_cache(cutoff, session_id=session_id, exclude=exclude)
+        return deleted, budget
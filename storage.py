@@ -0,0 +1,675 @@
+# encoding:utf-8
+"""
+聊天记录的存储后端：单文件SQLite、按会话哈希分片的多文件SQLite，以及用于测试的内存数据库
+"""
+import os
+import sqlite3
+import threading
+import weakref
+import zlib
+from contextlib import contextmanager
+
+from bridge.context import ContextType
+from common.log import logger
+from plugins.plugin_summary.tokenizer import normalize_content, record_tokens
+
+
+# 超过该字节数的文本压缩后存储
+COMPRESS_THRESHOLD = 1024
+
+
+# 较长的文本用zlib压缩后以BLOB存储，读取时按类型区分
+def pack_text(text, threshold=COMPRESS_THRESHOLD):
+    if text is None or threshold <= 0:
+        return text
+    data = text.encode("utf-8")
+    if len(data) < threshold:
+        return text
+    packed = zlib.compress(data)
+    return packed if len(packed) < len(data) else text
+
+
+def unpack_text(value):
+    if isinstance(value, bytes):
+        return zlib.decompress(value).decode("utf-8")
+    return value
+
+
+# 消息类型以ContextType的值存储
+def type_code(msg_type):
+    try:
+        return ContextType[str(msg_type).split(".")[-1]].value
+    except KeyError:
+        return 0
+
+
+def type_name(code):
+    try:
+        return str(ContextType(code))
+    except ValueError:
+        return "UNKNOWN"
+
+
+# 数据库结构版本迁移，每个函数对应一个版本，按顺序执行且每个版本只执行一次
+def _migrate_v1(conn):
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS chat_records
+                        (sessionid TEXT, msgid INTEGER, user TEXT, content TEXT, type TEXT, timestamp INTEGER, is_triggered INTEGER,
+                        PRIMARY KEY (sessionid, msgid))''')
+
+    # 创建一个总结时间表，记录合适开始了总结的时间
+    c.execute('''CREATE TABLE IF NOT EXISTS summary_time
+                        (sessionid TEXT, summary_time INTEGER, PRIMARY KEY (sessionid))''')
+
+    # 创建一个关闭保存聊天记录的表
+    c.execute('''CREATE TABLE IF NOT EXISTS summary_stop
+                        (sessionid TEXT, PRIMARY KEY (sessionid))''')
+
+    # 早期版本的库没有is_triggered字段
+    columns = [column[1] for column in c.execute("PRAGMA table_info(chat_records);").fetchall()]
+    if 'is_triggered' not in columns:
+        c.execute("ALTER TABLE chat_records ADD COLUMN is_triggered INTEGER DEFAULT 0;")
+        c.execute("UPDATE chat_records SET is_triggered = 0;")
+
+
+def _migrate_v2(conn):
+    # WAL模式不能在事务中开启，由SqliteStorage._migrate在迁移前设置
+    c = conn.cursor()
+    # get_records按会话过滤并按时间倒序，delete_records只按时间过滤
+    c.execute("CREATE INDEX IF NOT EXISTS idx_chat_records_session_time ON chat_records (sessionid, timestamp)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_chat_records_time ON chat_records (timestamp)")
+
+
+def _migrate_v3(conn):
+    # 每条记录在总结prompt中占用的token数，入库时计算，旧数据为NULL时在总结时补算
+    conn.execute("ALTER TABLE chat_records ADD COLUMN tokens INTEGER")
+
+
+def _migrate_v4(conn):
+    # 分段摘要缓存，start/end为该段最早和最新一条消息，content_hash用于确认该段消息未变化
+    conn.execute('''CREATE TABLE IF NOT EXISTS summary_cache
+                        (sessionid TEXT, start_msgid INTEGER, end_msgid INTEGER, content_hash TEXT, summary TEXT,
+                        msg_count INTEGER, start_timestamp INTEGER, end_timestamp INTEGER, create_time INTEGER,
+                        PRIMARY KEY (sessionid, start_msgid, end_msgid, content_hash))''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_summary_cache_session_time ON summary_cache (sessionid, start_timestamp)")
+
+
+def _migrate_v5(conn):
+    # 入库时预先计算总结用的内容，旧数据在这里回填，同时按回填后的内容重新计算token数
+    conn.execute("ALTER TABLE chat_records ADD COLUMN summary_text TEXT")
+    reader = conn.execute("SELECT rowid, user, content, type, is_triggered FROM chat_records")
+    while True:
+        rows = reader.fetchmany(1000)
+        if not rows:
+            break
+        updates = []
+        for rowid, user, content, msg_type, is_triggered in rows:
+            summary_text = normalize_content(content, msg_type)
+            updates.append((summary_text, record_tokens(user, summary_text, is_triggered), rowid))
+        conn.executemany("UPDATE chat_records SET summary_text = ?, tokens = ? WHERE rowid = ?", updates)
+
+
+def _migrate_v6(conn):
+    # 紧凑存储：会话名和用户名存入查找表，消息类型存为整数，原始内容与总结内容相同时不重复存储，长文本压缩
+    c = conn.cursor()
+    c.execute("CREATE TABLE IF NOT EXISTS sessions (id INTEGER PRIMARY KEY, name TEXT UNIQUE)")
+    c.execute("CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY, name TEXT UNIQUE)")
+    c.execute('''CREATE TABLE chat_records_compact
+                        (id INTEGER PRIMARY KEY, session INTEGER, msgid INTEGER, user INTEGER, type INTEGER,
+                        timestamp INTEGER, is_triggered INTEGER, tokens INTEGER, summary_text, content,
+                        UNIQUE (session, msgid))''')
+    c.execute("INSERT OR IGNORE INTO sessions (name) SELECT DISTINCT sessionid FROM chat_records")
+    c.execute("INSERT OR IGNORE INTO users (name) SELECT DISTINCT user FROM chat_records WHERE user IS NOT NULL")
+    conn.create_function("summary_type_code", 1, type_code)
+    conn.create_function("summary_pack_text", 1, pack_text)
+    c.execute('''INSERT INTO chat_records_compact
+                        (session, msgid, user, type, timestamp, is_triggered, tokens, summary_text, content)
+                        SELECT s.id, r.msgid, u.id, summary_type_code(r.type), r.timestamp, r.is_triggered, r.tokens,
+                        summary_pack_text(r.summary_text),
+                        CASE WHEN r.content IS r.summary_text THEN NULL ELSE summary_pack_text(r.content) END
+                        FROM chat_records r JOIN sessions s ON s.name = r.sessionid
+                        LEFT JOIN users u ON u.name = r.user ORDER BY r.timestamp''')
+    c.execute("DROP TABLE chat_records")
+    c.execute("ALTER TABLE chat_records_compact RENAME TO chat_records")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_chat_records_session_time ON chat_records (session, timestamp)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_chat_records_time ON chat_records (timestamp)")
+
+
+def _migrate_v7(conn):
+    # 会话状态合并为一张表：上次总结时间、是否禁用以及各会话单独的配置，NULL表示使用全局配置
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS session_state
+                        (sessionid TEXT PRIMARY KEY, summary_time INTEGER, disabled INTEGER NOT NULL DEFAULT 0,
+                        rate_limit INTEGER, max_chunks INTEGER, token_budget INTEGER)''')
+    c.execute("INSERT OR IGNORE INTO session_state (sessionid, summary_time) SELECT sessionid, summary_time FROM summary_time")
+    # 旧版本的summary_stop由"开启"指令写入、"关闭"指令删除，且读取时从未生效，其中的会话实际都处于开启状态，不做迁移
+    c.execute("DROP TABLE summary_time")
+    c.execute("DROP TABLE summary_stop")
+
+
+def _migrate_v8(conn):
+    # 总结内容的全文索引，trigram分词不依赖中文词典，不少于3个字的关键字可以直接走索引
+    # 索引引用chat_records中的内容，由触发器同步；压缩存储的文本通过summary_unpack_text解压，该函数在每个连接上注册
+    # INSERT OR REPLACE替换旧行时需要开启recursive_triggers才会触发删除
+    c = conn.cursor()
+    try:
+        c.execute("CREATE VIRTUAL TABLE chat_fts USING fts5(summary_text, content='chat_records', content_rowid='id', "
+                  "tokenize='trigram')")
+    except sqlite3.OperationalError as e:
+        logger.warning("[Summary] full-text search is not available, topic summary falls back to LIKE: {}".format(e))
+        return
+    c.execute('''CREATE TRIGGER chat_records_fts_insert AFTER INSERT ON chat_records BEGIN
+                        INSERT INTO chat_fts (rowid, summary_text) VALUES (new.id, summary_unpack_text(new.summary_text));
+                        END''')
+    c.execute('''CREATE TRIGGER chat_records_fts_delete AFTER DELETE ON chat_records BEGIN
+                        INSERT INTO chat_fts (chat_fts, rowid, summary_text)
+                        VALUES ('delete', old.id, summary_unpack_text(old.summary_text));
+                        END''')
+    c.execute('''CREATE TRIGGER chat_records_fts_update AFTER UPDATE OF summary_text ON chat_records BEGIN
+                        INSERT INTO chat_fts (chat_fts, rowid, summary_text)
+                        VALUES ('delete', old.id, summary_unpack_text(old.summary_text));
+                        INSERT INTO chat_fts (rowid, summary_text) VALUES (new.id, summary_unpack_text(new.summary_text));
+                        END''')
+    c.execute("INSERT INTO chat_fts (rowid, summary_text) SELECT id, summary_unpack_text(summary_text) FROM chat_records")
+
+
+MIGRATIONS = [_migrate_v1, _migrate_v2, _migrate_v3, _migrate_v4, _migrate_v5, _migrate_v6, _migrate_v7, _migrate_v8]
+
+# 会话状态的字段，除sessionid外均可单独更新
+SESSION_STATE_FIELDS = ["summary_time", "disabled", "rate_limit", "max_chunks", "token_budget"]
+
+
+class _ReaderHolder:
+    """只被线程局部变量引用，用于在线程结束时关闭该线程的只读连接"""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+
+class ConnectionManager:
+    """
+    一个串行化的写连接加上每个线程独立的只读连接，WAL模式下读写互不阻塞
+    """
+
+    def __init__(self, db_path, busy_timeout=5000, shared_reader=False):
+        self.db_path = db_path
+        self.busy_timeout = busy_timeout
+        # 内存数据库无法被多个连接共享，读取也使用写连接
+        self.shared_reader = shared_reader
+        self._write_lock = threading.RLock()
+        self._writer = self._connect()
+        self._local = threading.local()
+        self._readers = set()
+        self._readers_lock = threading.Lock()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=self.busy_timeout / 1000)
+        conn.execute("PRAGMA busy_timeout = {}".format(int(self.busy_timeout)))
+        # 全文索引的触发器依赖以下设置
+        conn.execute("PRAGMA recursive_triggers = ON")
+        conn.create_function("summary_unpack_text", 1, unpack_text)
+        return conn
+
+    # 写连接，同一时间只有一个线程持有；正常退出时提交，异常时回滚
+    @contextmanager
+    def write(self):
+        with self._write_lock:
+            try:
+                yield self._writer
+                self._writer.commit()
+            except Exception:
+                self._writer.rollback()
+                raise
+
+    # 当前线程的只读连接，首次使用时创建；线程结束后线程局部变量被回收，连接随之关闭
+    def reader(self):
+        if self.shared_reader:
+            return self._writer
+        holder = getattr(self._local, "reader", None)
+        if holder is None:
+            conn = self._connect()
+            conn.execute("PRAGMA query_only = 1")
+            holder = _ReaderHolder(conn)
+            with self._readers_lock:
+                self._readers.add(conn)
+            weakref.finalize(holder, self._close_reader, conn)
+            self._local.reader = holder
+        return holder.conn
+
+    def _close_reader(self, conn):
+        with self._readers_lock:
+            if conn not in self._readers:
+                return
+            self._readers.discard(conn)
+        conn.close()
+
+    def close(self):
+        with self._readers_lock:
+            readers, self._readers = self._readers, set()
+        for conn in readers:
+            conn.close()
+        with self._write_lock:
+            self._writer.close()
+
+
+class StorageBackend:
+    """
+    存储后端接口，Db在此之上提供写缓冲和便捷方法
+    records为(session_id, msg_id, user, content, msg_type, timestamp, is_triggered, tokens, summary_text)
+    """
+
+    # 批量写入记录，返回写入失败的记录
+    def insert_records(self, records) -> list:
+        raise NotImplementedError
+
+    # 返回(sessionid, msgid, user, content, type, timestamp, is_triggered, tokens)，content为归一化后的内容
+    def get_records(self, session_id, start_timestamp=0, limit=9999) -> list:
+        raise NotImplementedError
+
+    # 返回包含任一关键字的最近limit条记录及其前后各context条消息，格式与get_records相同
+    def search_records(self, session_id, keywords, start_timestamp=0, limit=9999, context=2) -> list:
+        raise NotImplementedError
+
+    # 根据时间删除记录，每次最多删除limit条，返回删除的条数
+    def delete_records(self, start_timestamp, session_id=None, exclude=(), limit=500) -> int:
+        raise NotImplementedError
+
+    # 删除最早的limit条记录，返回删除的条数
+    def delete_oldest_records(self, limit=500) -> int:
+        raise NotImplementedError
+
+    def get_summary_cache(self, session_id, start_timestamp=0) -> list:
+        raise NotImplementedError
+
+    # 在(start_timestamp, end_timestamp]内、最新一段摘要之后至少有min_messages条新消息的会话，按新消息数倒序
+    # 返回[(session_id, 新消息数, 最新一段摘要的结束时间)]
+    def pending_sessions(self, start_timestamp, end_timestamp, min_messages, limit=10) -> list:
+        raise NotImplementedError
+
+    def save_summary_cache(self, session_id, entries, create_time):
+        raise NotImplementedError
+
+    def delete_summary_cache(self, start_timestamp, session_id=None, exclude=()):
+        raise NotImplementedError
+
+    def get_session_state(self, session_id) -> dict:
+        raise NotImplementedError
+
+    def set_session_state(self, session_id, field, value):
+        raise NotImplementedError
+
+    # 实际使用的空间(字节)
+    def used_size(self) -> int:
+        raise NotImplementedError
+
+    def incremental_vacuum(self, pages=1000):
+        raise NotImplementedError
+
+    # 旧库开启增量回收需要整理重建整个数据库，返回是否执行了整理
+    def enable_incremental_vacuum(self) -> bool:
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+
+class SqliteStorage(StorageBackend):
+    """单个SQLite文件"""
+
+    def __init__(self, db_path, compress_threshold=COMPRESS_THRESHOLD, busy_timeout=5000, shared_reader=False):
+        self.db_path = db_path
+        self.connections = ConnectionManager(db_path, busy_timeout, shared_reader)
+        self._migrate()
+        # 不支持FTS5的SQLite上迁移时不会建立全文索引
+        self.fts = self.connections.reader().execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'chat_fts'").fetchone() is not None
+        self.compress_threshold = compress_threshold
+        self._vacuum_warned = False
+        # 会话名和用户名到查找表id的缓存
+        self._ids = {"sessions": {}, "users": {}}
+        # 会话状态在启动时全部载入内存，之后的读取直接使用缓存，写入时同步更新
+        self._session_state = self._load_session_state()
+        self._session_state_lock = threading.Lock()
+
+    def _migrate(self):
+        with self.connections.write() as conn:
+            # 新建的库直接开启增量回收，该设置只能在建表和开启WAL之前修改，对已有的库不生效
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+            # WAL模式下读写互不阻塞，该设置会持久化在数据库文件中，且不能在事务中修改
+            conn.execute("PRAGMA journal_mode=WAL;")
+            version = conn.execute("PRAGMA user_version;").fetchone()[0]
+            # sqlite3模块默认不把CREATE/ALTER等语句放进事务，这里手动开启事务，失败时整个版本的修改一起回滚
+            isolation_level = conn.isolation_level
+            conn.isolation_level = None
+            try:
+                for target, migration in enumerate(MIGRATIONS, start=1):
+                    if target <= version:
+                        continue
+                    logger.info("[Summary] migrate database {} to version {}".format(self.db_path, target))
+                    conn.execute("BEGIN")
+                    try:
+                        migration(conn)
+                        conn.execute("PRAGMA user_version = {};".format(target))
+                        conn.execute("COMMIT")
+                    except Exception:
+                        conn.execute("ROLLBACK")
+                        raise
+            finally:
+                conn.isolation_level = isolation_level
+
+    # 查找名称对应的id，不存在时返回None
+    def _lookup_id(self, table, name):
+        cache = self._ids[table]
+        if name not in cache:
+            row = self.connections.reader().execute("SELECT id FROM {} WHERE name = ?".format(table),
+                                                    (name,)).fetchone()
+            if row is None:
+                return None
+            cache[name] = row[0]
+        return cache[name]
+
+    # 查找名称对应的id，不存在时插入，需要在写事务中调用
+    def _intern_id(self, c, table, name):
+        if name is None:
+            return None
+        cache = self._ids[table]
+        if name not in cache:
+            c.execute("INSERT OR IGNORE INTO {} (name) VALUES (?)".format(table), (name,))
+            cache[name] = c.execute("SELECT id FROM {} WHERE name = ?".format(table), (name,)).fetchone()[0]
+        return cache[name]
+
+    def insert_records(self, records) -> list:
+        try:
+            with self.connections.write() as conn:
+                c = conn.cursor()
+                rows = []
+                for session_id, msg_id, user, content, msg_type, timestamp, is_triggered, tokens, summary_text in \
+                        records:
+                    rows.append((self._intern_id(c, "sessions", session_id), msg_id, self._intern_id(c, "users", user),
+                                 type_code(msg_type), timestamp, is_triggered, tokens,
+                                 pack_text(summary_text, self.compress_threshold),
+                                 None if content == summary_text else pack_text(content, self.compress_threshold)))
+                c.executemany("INSERT OR REPLACE INTO chat_records (session, msgid, user, type, timestamp, "
+                              "is_triggered, tokens, summary_text, content) VALUES (?,?,?,?,?,?,?,?,?)", rows)
+            return []
+        except Exception as e:
+            # 回滚后新插入的查找表id可能已失效
+            self._ids = {"sessions": {}, "users": {}}
+            logger.error("[Summary] insert records failed: {}".format(e))
+            return list(records)
+
+    def get_records(self, session_id, start_timestamp=0, limit=9999) -> list:
+        session = self._lookup_id("sessions", session_id)
+        if session is None:
+            return []
+        c = self.connections.reader().execute(
+            "SELECT r.msgid, u.name, r.summary_text, r.type, r.timestamp, r.is_triggered, r.tokens "
+            "FROM chat_records r LEFT JOIN users u ON u.id = r.user "
+            "WHERE r.session=? and r.timestamp>? ORDER BY r.timestamp DESC LIMIT ?",
+            (session, start_timestamp, limit))
+        return [(session_id, msg_id, user, unpack_text(summary_text), type_name(msg_type), timestamp, is_triggered,
+                 tokens) for msg_id, user, summary_text, msg_type, timestamp, is_triggered, tokens in c.fetchall()]
+
+    def search_records(self, session_id, keywords, start_timestamp=0, limit=9999, context=2) -> list:
+        session = self._lookup_id("sessions", session_id)
+        keywords = [keyword for keyword in keywords if keyword]
+        if session is None or not keywords:
+            return []
+        # trigram索引只能匹配不少于3个字的关键字，较短的关键字在该会话的记录中逐条匹配
+        conditions, params = [], []
+        indexed = [keyword for keyword in keywords if self.fts and len(keyword) >= 3]
+        if indexed:
+            conditions.append("id IN (SELECT rowid FROM chat_fts WHERE chat_fts MATCH ?)")
+            params.append(" OR ".join('"{}"'.format(keyword.replace('"', '""')) for keyword in indexed))
+        for keyword in keywords:
+            if keyword not in indexed:
+                conditions.append("(CASE WHEN typeof(summary_text) = 'blob' THEN summary_unpack_text(summary_text) "
+                                  "ELSE summary_text END) LIKE ? ESCAPE '\\'")
+                params.append("%{}%".format(keyword.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")))
+        # 按时间给会话内的消息编号，取命中的消息以及编号相邻的上下文
+        c = self.connections.reader().execute(
+            "WITH s AS (SELECT id, ROW_NUMBER() OVER (ORDER BY timestamp, id) AS rn, ({}) AS hit "
+            "FROM chat_records WHERE session=? and timestamp>?), "
+            "hits AS (SELECT rn FROM s WHERE hit ORDER BY rn DESC LIMIT ?), "
+            "picked AS (SELECT DISTINCT s.id FROM s JOIN hits ON s.rn BETWEEN hits.rn - ? AND hits.rn + ?) "
+            "SELECT r.msgid, u.name, r.summary_text, r.type, r.timestamp, r.is_triggered, r.tokens "
+            "FROM picked p JOIN chat_records r ON r.id = p.id LEFT JOIN users u ON u.id = r.user "
+            "ORDER BY r.timestamp DESC".format(" OR ".join(conditions)),
+            params + [session, start_timestamp, limit, context, context])
+        return [(session_id, msg_id, user, unpack_text(summary_text), type_name(msg_type), timestamp, is_triggered,
+                 tokens) for msg_id, user, summary_text, msg_type, timestamp, is_triggered, tokens in c.fetchall()]
+
+    # 按会话范围拼接过滤条件，session_id指定单个会话，exclude为需要跳过的会话
+    # chat_records中的会话为sessions表的id，其余表直接存储会话名
+    @staticmethod
+    def _session_filter(session_id, exclude, column="sessionid"):
+        names = "?" if session_id is not None else ",".join("?" * len(exclude))
+        if column == "session":
+            names = "SELECT id FROM sessions WHERE name IN ({})".format(names)
+        if session_id is not None:
+            return " AND {} IN ({})".format(column, names), [session_id]
+        if exclude:
+            return " AND {} NOT IN ({})".format(column, names), list(exclude)
+        return "", []
+
+    def delete_records(self, start_timestamp, session_id=None, exclude=(), limit=500) -> int:
+        where, params = self._session_filter(session_id, exclude, column="session")
+        try:
+            with self.connections.write() as conn:
+                c = conn.execute("DELETE FROM chat_records WHERE rowid IN "
+                                 "(SELECT rowid FROM chat_records WHERE timestamp < ?" + where + " LIMIT ?)",
+                                 [start_timestamp] + params + [limit])
+                return c.rowcount
+        except Exception as e:
+            logger.error(e)
+            return 0
+
+    def delete_oldest_records(self, limit=500) -> int:
+        try:
+            with self.connections.write() as conn:
+                c = conn.execute("DELETE FROM chat_records WHERE rowid IN "
+                                 "(SELECT rowid FROM chat_records ORDER BY timestamp LIMIT ?)", (limit,))
+                return c.rowcount
+        except Exception as e:
+            logger.error(e)
+            return 0
+
+    # 获取起始时间不早于start_timestamp的分段摘要缓存，按时间倒序
+    def get_summary_cache(self, session_id, start_timestamp=0) -> list:
+        c = self.connections.reader().execute(
+            "SELECT start_msgid, end_msgid, content_hash, summary, msg_count FROM summary_cache "
+            "WHERE sessionid=? and start_timestamp>=? ORDER BY end_timestamp DESC",
+            (session_id, start_timestamp))
+        return c.fetchall()
+
+    def pending_sessions(self, start_timestamp, end_timestamp, min_messages, limit=10) -> list:
+        c = self.connections.reader().execute(
+            "SELECT s.name, COUNT(*) AS pending, d.digested FROM chat_records r JOIN sessions s ON s.id = r.session "
+            "LEFT JOIN (SELECT sessionid, MAX(end_timestamp) AS digested FROM summary_cache GROUP BY sessionid) d "
+            "ON d.sessionid = s.name WHERE r.timestamp > MAX(COALESCE(d.digested, 0), ?) AND r.timestamp <= ? "
+            "GROUP BY s.name HAVING pending >= ? ORDER BY pending DESC LIMIT ?",
+            (start_timestamp, end_timestamp, min_messages, limit))
+        return c.fetchall()
+
+    # 保存分段摘要缓存，entries为(start_msgid, end_msgid, content_hash, summary, msg_count, start_timestamp, end_timestamp)
+    def save_summary_cache(self, session_id, entries, create_time):
+        try:
+            with self.connections.write() as conn:
+                conn.executemany("INSERT OR REPLACE INTO summary_cache VALUES (?,?,?,?,?,?,?,?,?)",
+                                 [(session_id,) + tuple(entry) + (create_time,) for entry in entries])
+        except Exception as e:
+            logger.error(e)
+
+    # 删除过期的分段摘要缓存，与聊天记录的保存时间保持一致
+    def delete_summary_cache(self, start_timestamp, session_id=None, exclude=()):
+        where, params = self._session_filter(session_id, exclude)
+        try:
+            with self.connections.write() as conn:
+                conn.execute("DELETE FROM summary_cache WHERE start_timestamp < ?" + where, [start_timestamp] + params)
+        except Exception as e:
+            logger.error(e)
+
+    def _load_session_state(self):
+        c = self.connections.reader().execute("SELECT sessionid, {} FROM session_state".format(
+            ", ".join(SESSION_STATE_FIELDS)))
+        return {row[0]: dict(zip(SESSION_STATE_FIELDS, row[1:])) for row in c.fetchall()}
+
+    # 获取会话状态，不存在时返回默认值
+    def get_session_state(self, session_id) -> dict:
+        state = self._session_state.get(session_id)
+        if state is None:
+            state = dict.fromkeys(SESSION_STATE_FIELDS)
+            state["disabled"] = 0
+            return state
+        return dict(state)
+
+    # 更新会话状态的某个字段，一条语句完成插入或更新
+    def set_session_state(self, session_id, field, value):
+        if field not in SESSION_STATE_FIELDS:
+            raise ValueError("unknown session state field: {}".format(field))
+        logger.debug("[Summary] set session state: {} {}={}".format(session_id, field, value))
+        with self._session_state_lock:
+            with self.connections.write() as conn:
+                conn.execute("INSERT INTO session_state (sessionid, {0}) VALUES (?, ?) "
+                             "ON CONFLICT(sessionid) DO UPDATE SET {0} = excluded.{0}".format(field),
+                             (session_id, value))
+            state = self.get_session_state(session_id)
+            state[field] = value
+            self._session_state[session_id] = state
+
+    # 数据库中实际使用的空间(字节)，不含空闲页
+    def used_size(self) -> int:
+        conn = self.connections.reader()
+        page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+        freelist_count = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        return (page_count - freelist_count) * page_size
+
+    # 增量回收空闲页，未开启增量回收的旧库跳过，整理由enable_incremental_vacuum显式执行
+    def incremental_vacuum(self, pages=1000):
+        try:
+            with self.connections.write() as conn:
+                if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                    if not self._vacuum_warned:
+                        self._vacuum_warned = True
+                        logger.warning("[Summary] incremental vacuum is not enabled on {}, set retention_vacuum_rebuild "
+                                       "to rebuild it once".format(self.db_path))
+                    return
+                conn.execute("PRAGMA incremental_vacuum({})".format(int(pages))).fetchall()
+        except Exception as e:
+            logger.error("[Summary] vacuum failed: {}".format(e))
+
+    # 整理期间持有写锁，耗时与数据库大小成正比
+    def enable_incremental_vacuum(self) -> bool:
+        try:
+            with self.connections.write() as conn:
+                if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+                    return False
+                logger.info("[Summary] enable incremental vacuum, rebuild database {}".format(self.db_path))
+                conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+                conn.execute("VACUUM")
+                return True
+        except Exception as e:
+            logger.error("[Summary] vacuum failed: {}".format(e))
+            return False
+
+    def close(self):
+        self.connections.close()
+
+
+class MemoryStorage(SqliteStorage):
+    """内存数据库，读写共用一个连接，仅用于测试和压测"""
+
+    def __init__(self, compress_threshold=COMPRESS_THRESHOLD):
+        super().__init__(":memory:", compress_threshold, shared_reader=True)
+
+
+class ShardedStorage(StorageBackend):
+    """
+    按会话哈希分布到多个SQLite文件，不同群的写入和查询互不争用同一把锁
+    分片数确定后不能再修改，否则已有会话会被映射到其他分片
+    """
+
+    def __init__(self, db_path, shards=8, compress_threshold=COMPRESS_THRESHOLD, busy_timeout=5000):
+        root, ext = os.path.splitext(db_path)
+        self.shards = [SqliteStorage("{}-{}{}".format(root, i, ext or ".db"), compress_threshold, busy_timeout)
+                       for i in range(shards)]
+
+    def shard(self, session_id) -> SqliteStorage:
+        return self.shards[zlib.crc32(str(session_id).encode("utf-8")) % len(self.shards)]
+
+    def insert_records(self, records) -> list:
+        groups = {}
+        for record in records:
+            groups.setdefault(id(self.shard(record[0])), (self.shard(record[0]), []))[1].append(record)
+        failed = []
+        for shard, rows in groups.values():
+            failed.extend(shard.insert_records(rows))
+        return failed
+
+    def get_records(self, session_id, start_timestamp=0, limit=9999) -> list:
+        return self.shard(session_id).get_records(session_id, start_timestamp, limit)
+
+    def search_records(self, session_id, keywords, start_timestamp=0, limit=9999, context=2) -> list:
+        return self.shard(session_id).search_records(session_id, keywords, start_timestamp, limit, context)
+
+    def delete_records(self, start_timestamp, session_id=None, exclude=(), limit=500) -> int:
+        if session_id is not None:
+            return self.shard(session_id).delete_records(start_timestamp, session_id=session_id, limit=limit)
+        return sum(shard.delete_records(start_timestamp, exclude=exclude, limit=limit) for shard in self.shards)
+
+    # 从占用空间最大的分片中删除
+    def delete_oldest_records(self, limit=500) -> int:
+        return max(self.shards, key=lambda shard: shard.used_size()).delete_oldest_records(limit)
+
+    def get_summary_cache(self, session_id, start_timestamp=0) -> list:
+        return self.shard(session_id).get_summary_cache(session_id, start_timestamp)
+
+    def save_summary_cache(self, session_id, entries, create_time):
+        self.shard(session_id).save_summary_cache(session_id, entries, create_time)
+
+    def pending_sessions(self, start_timestamp, end_timestamp, min_messages, limit=10) -> list:
+        sessions = []
+        for shard in self.shards:
+            sessions.extend(shard.pending_sessions(start_timestamp, end_timestamp, min_messages, limit))
+        return sorted(sessions, key=lambda session: session[1], reverse=True)[:limit]
+
+    def delete_summary_cache(self, start_timestamp, session_id=None, exclude=()):
+        if session_id is not None:
+            self.shard(session_id).delete_summary_cache(start_timestamp, session_id=session_id)
+            return
+        for shard in self.shards:
+            shard.delete_summary_cache(start_timestamp, exclude=exclude)
+
+    def get_session_state(self, session_id) -> dict:
+        return self.shard(session_id).get_session_state(session_id)
+
+    def set_session_state(self, session_id, field, value):
+        self.shard(session_id).set_session_state(session_id, field, value)
+
+    def used_size(self) -> int:
+        return sum(shard.used_size() for shard in self.shards)
+
+    def incremental_vacuum(self, pages=1000):
+        for shard in self.shards:
+            shard.incremental_vacuum(pages)
+
+    def enable_incremental_vacuum(self) -> bool:
+        return any([shard.enable_incremental_vacuum() for shard in self.shards])
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+
+
+def create_storage(storage="single", db_path=None, shards=8, compress_threshold=COMPRESS_THRESHOLD,
+                   busy_timeout=5000) -> StorageBackend:
+    if storage == "memory":
+        return MemoryStorage(compress_threshold)
+    if db_path is None:
+        db_path = os.path.join(os.path.dirname(__file__), "chat.db")
+    if storage == "sharded":
+        return ShardedStorage(db_path, shards, compress_threshold, busy_timeout)
+    if storage != "single":
+        raise ValueError("[Summary] unknown storage backend: {}".format(storage))
+    return SqliteStorage(db_path, compress_threshold, busy_timeout)
@@ -0,0 +1,39 @@
+# encoding:utf-8
+import time
+
+import pytest
+
+from plugins.plugin_summary.command_parser import cn_to_int, parse_summary_command
+
+# 本地时间当天的15:30
+NOW = time.mktime((2024, 5, 20, 15, 30, 0, 0, 0, -1))
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("99", 99), ("五", 5), ("十", 10), ("十五", 15), ("二十五", 25), ("一百零五", 105), ("三百五", 350),
+    ("一千二", 1200), ("两万", 20000), ("两万五", 25000), ("五万三千二", 53200), ("一万零五", 10005),
+])
+def test_cn_to_int(text, expected):
+    assert cn_to_int(text) == expected
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("", {}),
+    ("一下", {}),
+    ("前五十条", {"count": 50}),
+    ("最近99条消息", {"count": 99}),
+    ("3 小时内消息", {"duration_in_seconds": 3 * 3600}),
+    ("最近半天", {"duration_in_seconds": 43200}),
+    ("一个半小时", {"duration_in_seconds": 5400}),
+    ("今天", {"duration_in_seconds": 15 * 3600 + 30 * 60}),
+    ("关于发布的讨论", {"keywords": ["发布"]}),
+    ("今天 关于 上线和回滚", {"duration_in_seconds": 15 * 3600 + 30 * 60, "keywords": ["上线", "回滚"]}),
+    ("2小时内前100条", {"count": 100, "duration_in_seconds": 7200}),
+])
+def test_parse_summary_command(text, expected):
+    assert parse_summary_command(text, NOW) == expected
+
+
+@pytest.mark.parametrize("text", ["昨天", "前天的消息", "帮我看看大家在吵什么"])
+def test_parse_summary_command_fallback(text):
+    assert parse_summary_command(text, NOW) is None
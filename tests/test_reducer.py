@@ -0,0 +1,42 @@
+# encoding:utf-8
+from bridge.reply import ReplyType
+from plugins.plugin_summary.benchmark import FakeBot
+from plugins.plugin_summary.db import Db
+from plugins.plugin_summary.main import Summary
+from plugins.plugin_summary.reducer import MessageReducer
+
+
+def _record(msg_id, user, content, timestamp):
+    return ("群聊", msg_id, user, content, "TEXT", timestamp, 0)
+
+
+def test_trailing_dropped_messages_counted_on_newest():
+    reducer = MessageReducer({"reduce_merge_gap": 0})
+    # 按时间倒序，最新的两条是插件指令
+    records = [
+        _record(5, "王五", "$总结 开启", 1005),
+        _record(4, "李四", "$总结", 1004),
+        _record(3, "李四", "晚上八点开会", 1003),
+        _record(2, "张三", "哈哈", 1002),
+        _record(1, "张三", "明天发布新版本", 1001),
+    ]
+    reduced, sources, _ = reducer.reduce(records)
+    assert [record[1] for record in reduced] == [3, 1]
+    assert sources == [4, 1]
+    assert sum(sources) == len(records)
+
+
+def test_long_monologue_split_into_chunkable_records(tmp_path):
+    db = Db(db_path=str(tmp_path / "chat.db"))
+    plugin = Summary(config={"save_time": -1}, db=db, bot=FakeBot())
+    try:
+        # 同一用户连续发言150条，每条约60字，合并成一条会超出分段的token预算
+        for i in range(150):
+            db.insert_record("群聊", i + 1, "张三", "第%03d条：" % i + "今天讨论新版本的发布流程和回滚方案" * 3, "TEXT",
+                             1000 + i, 0)
+        db.flush()
+        reply = plugin._summarize_records("群聊", 0, 150, plugin.metrics.trace("群聊"))
+        assert reply.type == ReplyType.TEXT
+        assert reply.content.startswith("本次总结了150条消息。")
+    finally:
+        db.close()
@@ -0,0 +1,131 @@
+# encoding:utf-8
+"""
+在chatgpt-on-wechat根目录下执行：python -m pytest plugins/plugin_summary/tests
+"""
+import sqlite3
+
+import pytest
+
+from plugins.plugin_summary.db import Db
+
+
+# 升级前版本的表结构，没有user_version
+def _create_baseline_db(db_path, rows):
+    conn = sqlite3.connect(db_path)
+    conn.execute('''CREATE TABLE chat_records
+                        (sessionid TEXT, msgid INTEGER, user TEXT, content TEXT, type TEXT, timestamp INTEGER,
+                        is_triggered INTEGER, PRIMARY KEY (sessionid, msgid))''')
+    conn.execute("CREATE TABLE summary_time (sessionid TEXT, summary_time INTEGER, PRIMARY KEY (sessionid))")
+    conn.execute("CREATE TABLE summary_stop (sessionid TEXT, PRIMARY KEY (sessionid))")
+    conn.executemany("INSERT INTO chat_records VALUES (?,?,?,?,?,?,?)", rows)
+    conn.execute("INSERT INTO summary_time VALUES ('群聊', 1700000000)")
+    conn.commit()
+    conn.close()
+
+
+def test_upgrade_baseline_db(tmp_path):
+    db_path = str(tmp_path / "chat.db")
+    rows = [
+        ("群聊", 1, "张三", "明天发布新版本", "TEXT", 1000, 0),
+        ("群聊", 2, "李四", "收到", "TEXT", 1001, 0),
+        ("群聊", 3, "王五", "/tmp/a.png", "IMAGE", 1002, 0),
+        ("群聊", 4, "张三", "发布前记得回归测试" * 200, "TEXT", 1003, 1),
+        ("另一个群", 1, "赵六", "发布会改期了", "TEXT", 1004, 0),
+    ]
+    _create_baseline_db(db_path, rows)
+
+    db = Db(db_path=db_path, flush_interval=0)
+    try:
+        records = db.get_records("群聊")
+        assert [record[1] for record in records] == [4, 3, 2, 1]
+        assert records[1][3] == "[IMAGE]"
+        assert records[0][3] == "发布前记得回归测试" * 200
+        assert all(record[7] for record in records)
+        assert db.get_summary_time("群聊") == 1700000000
+
+        assert [record[1] for record in db.search_records("群聊", ["发布"], context=0)] == [4, 1]
+        assert [record[1] for record in db.search_records("群聊", ["回归测试"], context=0)] == [4]
+        assert [record[1] for record in db.search_records("群聊", ["新版本"], context=1)] == [2, 1]
+        assert [record[1] for record in db.search_records("另一个群", ["发布会"])] == [1]
+    finally:
+        db.close()
+
+    # 再次打开时不重复迁移
+    db = Db(db_path=db_path, flush_interval=0)
+    try:
+        assert len(db.get_records("群聊")) == 4
+    finally:
+        db.close()
+
+
+def test_failed_migration_rolls_back(tmp_path, monkeypatch):
+    from plugins.plugin_summary import storage
+
+    db_path = str(tmp_path / "chat.db")
+    _create_baseline_db(db_path, [("群聊", 1, "张三", "你好", "TEXT", 1000, 0)])
+
+    def broken_v5(conn):
+        conn.execute("ALTER TABLE chat_records ADD COLUMN summary_text TEXT")
+        raise RuntimeError("interrupted")
+
+    migrations = list(storage.MIGRATIONS)
+    monkeypatch.setattr(storage, "MIGRATIONS", migrations[:4] + [broken_v5])
+    with pytest.raises(RuntimeError):
+        Db(db_path=db_path, flush_interval=0)
+
+    conn = sqlite3.connect(db_path)
+    assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == 4
+    columns = [column[1] for column in conn.execute("PRAGMA table_info(chat_records)")]
+    assert "summary_text" not in columns
+    conn.close()
+
+    # 修复后重试可以继续迁移
+    monkeypatch.setattr(storage, "MIGRATIONS", migrations)
+    db = Db(db_path=db_path, flush_interval=0)
+    try:
+        assert [record[3] for record in db.get_records("群聊")] == ["你好"]
+    finally:
+        db.close()
+
+
+def test_reader_connections_closed_with_thread(tmp_path):
+    import threading
+
+    db = Db(db_path=str(tmp_path / "chat.db"), flush_interval=0)
+    try:
+        connections = db.storage.connections
+        threads = [threading.Thread(target=db.get_records, args=("群聊",)) for _ in range(50)]
+        for thread in threads:
+            thread.start()
+            thread.join()
+        assert len(connections._readers) <= 1
+    finally:
+        db.close()
+
+
+def _auto_vacuum(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_incremental_vacuum(tmp_path):
+    db = Db(db_path=str(tmp_path / "new.db"), flush_interval=0)
+    db.close()
+    assert _auto_vacuum(str(tmp_path / "new.db")) == 2
+
+    # 旧库只有显式整理后才开启增量回收
+    db_path = str(tmp_path / "chat.db")
+    _create_baseline_db(db_path, [("群聊", 1, "张三", "你好", "TEXT", 1000, 0)])
+    db = Db(db_path=db_path, flush_interval=0)
+    try:
+        db.incremental_vacuum()
+        assert _auto_vacuum(db_path) == 0
+        assert db.enable_incremental_vacuum()
+        assert _auto_vacuum(db_path) == 2
+        assert not db.enable_incremental_vacuum()
+    finally:
+        db.close()
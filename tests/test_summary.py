@@ -0,0 +1,75 @@
+# encoding:utf-8
+import pytest
+
+from bridge.reply import ReplyType
+from plugins.plugin_summary.benchmark import FakeBot
+from plugins.plugin_summary.db import Db
+from plugins.plugin_summary.main import Summary
+
+
+@pytest.fixture
+def plugin(tmp_path):
+    db = Db(db_path=str(tmp_path / "chat.db"))
+    plugin = Summary(config={"save_time": -1, "reduce": False}, db=db, bot=FakeBot())
+    yield plugin
+    db.close()
+
+
+def test_oversized_record_truncated_instead_of_ending_plan(plugin):
+    for i in range(300):
+        content = "粘贴的日志" * 1600 if i == 100 else "第%03d条：明天上午发布新版本" % i
+        plugin.db.insert_record("群聊", i + 1, "用户%d" % (i % 7), content, "TEXT", 1000 + i, 0)
+    plugin.db.flush()
+    reply = plugin._summarize_records("群聊", 0, 300, plugin.metrics.trace("群聊"))
+    assert reply.type == ReplyType.TEXT
+    assert reply.content.startswith("本次总结了300条消息。\n\n")
+
+
+def test_time_range_capped_by_max_range_records(plugin):
+    plugin.config["max_range_records"] = 50
+    for i in range(80):
+        plugin.db.insert_record("群聊", i + 1, "用户%d" % (i % 7), "第%03d条：明天上午发布新版本" % i, "TEXT", 1000 + i, 0)
+    plugin.db.flush()
+    reply = plugin._summarize_records("群聊", 0, None, plugin.metrics.trace("群聊"))
+    assert reply.type == ReplyType.TEXT
+    assert reply.content.startswith("本次总结了50条消息。时间范围内的消息超过50条，只总结了最新的50条。\n\n")
+
+
+class FailingBot(FakeBot):
+    """第一段之后的请求都失败"""
+
+    def reply_text(self, session, *args, **kwargs):
+        if self.stats["calls"] >= 1:
+            return {"total_tokens": 0, "completion_tokens": 0, "content": "请求失败"}
+        return super().reply_text(session, *args, **kwargs)
+
+
+def test_reply_mentions_omitted_records(plugin):
+    plugin.bot = FailingBot()
+    for i in range(300):
+        plugin.db.insert_record("群聊", i + 1, "用户%d" % (i % 7), "第%03d条：" % i + "明天上午发布新版本" * 5, "TEXT",
+                                1000 + i, 0)
+    plugin.db.flush()
+    reply = plugin._summarize_records("群聊", 0, 300, plugin.metrics.trace("群聊"))
+    assert reply.type == ReplyType.TEXT
+    count = int(reply.content[len("本次总结了"):reply.content.index("条消息")])
+    assert 0 < count < 300
+    assert "另有%d条较早的消息未能总结。" % (300 - count) in reply.content
+
+
+@pytest.mark.parametrize("args", [["预算", "100"], ["频率", "-5"], ["频率", "0"], ["段数", "1"], ["预算", "abc"]])
+def test_invalid_session_setting_rejected(plugin, args):
+    reply = plugin._update_session_setting("群聊", args)
+    assert reply.type == ReplyType.ERROR
+    state = plugin.db.get_session_state("群聊")
+    assert state["token_budget"] is None and state["rate_limit"] is None and state["max_chunks"] is None
+
+
+def test_session_setting(plugin):
+    assert plugin._update_session_setting("群聊", ["预算", "3000"]).type == ReplyType.INFO
+    assert plugin._update_session_setting("群聊", ["段数", "2"]).type == ReplyType.INFO
+    state = plugin.db.get_session_state("群聊")
+    assert (state["token_budget"], state["max_chunks"]) == (3000, 2)
+    assert plugin._update_session_setting("群聊", ["预算", "默认"]).type == ReplyType.INFO
+    state = plugin.db.get_session_state("群聊")
+    assert (state["token_budget"], state["max_chunks"]) == (None, 2)
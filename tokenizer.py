@@ -0,0 +1,53 @@
+# encoding:utf-8
+"""
+聊天记录的归一化和token估算，入库时计算一次，总结时直接使用，避免反复对整段prompt做正则处理和分词
+"""
+import re
+
+from bridge.context import ContextType
+from common.log import logger
+
+try:
+    import tiktoken
+
+    _encoding = tiktoken.get_encoding("cl100k_base")
+except Exception as e:
+    logger.warning("[Summary] tiktoken unavailable, estimate tokens by characters: {}".format(e))
+    _encoding = None
+
+MEDIA_TYPES = [str(ContextType.IMAGE), str(ContextType.VOICE)]
+# 引用回复的消息中，分隔线之前是被引用的内容
+QUOTE_PATTERN = re.compile(r'\n- - - - - - - - -.*?\n')
+
+
+def num_tokens(text):
+    if not text:
+        return 0
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    # 没有tiktoken时按字符数估算，中文场景下偏保守
+    return len(text)
+
+
+# 总结时使用的消息内容：图片和语音替换为占位符，引用回复只保留回复部分
+def normalize_content(content, msg_type):
+    if msg_type in MEDIA_TYPES:
+        return f"[{msg_type}]"
+    if content is None:
+        return ""
+    clist = QUOTE_PATTERN.split(content)
+    if len(clist) > 1:
+        return clist[1]
+    return content
+
+
+# 单条聊天记录在总结prompt中的文本形式，content为归一化后的内容
+def record_sentence(username, content, is_triggered):
+    sentence = f'{username}' + ": \"" + content + "\""
+    if is_triggered:
+        sentence += " <T>"
+    return "\n\n" + sentence
+
+
+def record_tokens(username, content, is_triggered):
+    return num_tokens(record_sentence(username, content, is_triggered))